@@ -0,0 +1,368 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""aio: the asyncio execution engine for paramgmt.
+
+This module requires Python 3.8+ and is only imported when a Controller is
+created with engine='asyncio', or probes its hosts. Every AsyncCommand is a
+coroutine on a single event loop instead of an OS thread, so one process can
+manage many more concurrent hosts.
+"""
+
+import asyncio
+import collections
+import errno
+import os
+import subprocess
+import traceback
+
+from . import paramgmt
+
+# file descriptors kept free of probes for everything else in the process
+_PROBE_FD_HEADROOM = 64
+
+# what _probe_one() returns when the process is out of file descriptors
+_OUT_OF_FDS = object()
+
+
+class AsyncCommand(paramgmt._CommandBase):
+  """The asyncio counterpart of Command.
+
+  It has the same attributes and status() as Command, but is run by awaiting
+  run_async() instead of starting a thread.
+  """
+
+  async def run_async(self):
+    """Runs the process until success, a non-SSH failure, or max_attempts."""
+    self.started_at = paramgmt._now()
+    self.deadline = self._deadline()
+    while (self.attempts < self.max_attempts and not self.cancelled and
+           not self.skipped):
+      retry = self.attempts > 0
+      if retry:
+        delay = self._retry_delay()
+        if delay is None:
+          break
+        await asyncio.sleep(delay)
+        while not self.retry_policy.try_acquire():
+          if self.cancelled:
+            return
+          await asyncio.sleep(paramgmt._RETRY_POLL)
+        if self.cancelled:
+          self.retry_policy.release()
+          break
+      try:
+        again = await self._run_attempt()
+      finally:
+        if retry:
+          self.retry_policy.release()
+      if not again:
+        break
+
+  async def _run_attempt(self):
+    """Runs the process once, returning whether to retry."""
+    delay = self._launch_delay()
+    if delay > 0:
+      await asyncio.sleep(delay)
+    if self.cancelled:
+      return False
+    out, err = self._start_attempt()
+    if self.stdin:
+      stdin_fd = subprocess.PIPE
+    else:
+      stdin_fd = None
+
+    self.process = await asyncio.create_subprocess_exec(
+        *self.commands, stdin=stdin_fd, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, **paramgmt._popen_options(self._killable()))
+
+    stdin = self._open_stdin()
+    try:
+      retcode, timed_out = await _pump(self.process, stdin, out, err,
+                                       self.deadline)
+    finally:
+      if stdin is not None:
+        stdin.close()
+    if self.checksum is not None:
+      # hashing a large download would stall every other command
+      return await asyncio.get_running_loop().run_in_executor(
+          None, self._finish_attempt, retcode, timed_out)
+    return self._finish_attempt(retcode, timed_out)
+
+
+async def _feed(writer, stdin):
+  """Copies a file object to a process's stdin, then closes it."""
+  try:
+    while True:
+      data = stdin.read(paramgmt._READ_CHUNK)
+      if not data:
+        break
+      writer.write(data)
+      await writer.drain()
+  except (BrokenPipeError, ConnectionResetError):
+    pass
+  writer.close()
+
+
+async def _drain(reader, capture):
+  """Moves a process's output into a capture until end of file."""
+  while True:
+    data = await reader.read(paramgmt._READ_CHUNK)
+    if not data:
+      break
+    capture.write(data)
+
+
+async def _pump(process, stdin, out, err, deadline=None):
+  """The asyncio counterpart of paramgmt._pump()."""
+  tasks = [_drain(process.stdout, out), _drain(process.stderr, err)]
+  if process.stdin is not None:
+    tasks.append(_feed(process.stdin, stdin))
+  pumping = asyncio.gather(*tasks)
+  timed_out = False
+  if deadline is None:
+    await pumping
+  else:
+    try:
+      await asyncio.wait_for(asyncio.shield(pumping),
+                             max(0, deadline - paramgmt._now()))
+    except asyncio.TimeoutError:
+      timed_out = True
+      paramgmt._kill_group(process)
+      try:
+        await asyncio.wait_for(pumping, paramgmt._KILL_GRACE)
+      except asyncio.TimeoutError:
+        # something outside the process group holds the pipes open
+        pass
+  if deadline is not None and not timed_out:
+    # the process may keep running after closing its output
+    try:
+      await asyncio.wait_for(process.wait(),
+                             max(0, deadline - paramgmt._now()))
+    except asyncio.TimeoutError:
+      timed_out = True
+      paramgmt._kill_group(process)
+  return await process.wait(), timed_out
+
+
+async def _run_one(mgmt_command):
+  """Runs one command, reporting errors like an unhandled thread exception."""
+  try:
+    await mgmt_command.run_async()
+  except Exception:
+    traceback.print_exc()
+  return mgmt_command
+
+
+async def schedule(mgmt_commands, fanout, per_host=None, progress=None,
+                   rollout=None, priority=None):
+  """This runs the specified commands with at most 'fanout' at once.
+
+  Args:
+    mgmt_commands : An iterable of AsyncCommands
+    fanout        : The maximum number of commands running at once
+    per_host      : The maximum number of commands running at once on each
+                    host, or None for no limit
+    progress      : The _Progress told about started and completed commands,
+                    or None
+    rollout       : The _Rollout deciding when commands may start, or None
+    priority      : A function of an AsyncCommand giving the key by which the
+                    commands are started, lowest first, or None
+
+  Yields:
+    Each AsyncCommand as it completes, in completion order
+  """
+
+  slots = paramgmt._HostSlots(mgmt_commands, per_host, progress, rollout,
+                              priority)
+  running = set()
+  while True:
+    # fill all free slots
+    while len(running) < fanout:
+      mgmt_command = slots.take()
+      if mgmt_command is None:
+        break
+      running.add(asyncio.ensure_future(_run_one(mgmt_command)))
+    if not running:
+      for mgmt_command in slots.remaining():
+        yield mgmt_command
+      return
+
+    # wait for any command to finish
+    done, running = await asyncio.wait(
+        running, return_when=asyncio.FIRST_COMPLETED)
+    for task in done:
+      mgmt_command = task.result()
+      slots.release(mgmt_command)
+      yield mgmt_command
+
+
+async def run_commands(mgmt_commands, fanout, reporter, sequencer,
+                       priority=None):
+  """This runs and reports the specified commands.
+
+  Args:
+    mgmt_commands : A list of AsyncCommands
+    fanout        : The maximum number of commands running at once
+    reporter      : The _Reporter that displays results
+    sequencer     : A _Sequencer if results are reported in order, else None
+    priority      : A function of an AsyncCommand giving the key by which the
+                    commands are started, lowest first, or None
+
+  Returns:
+    The list of completed AsyncCommands
+  """
+
+  try:
+    async for mgmt_command in schedule(mgmt_commands, fanout,
+                                       progress=reporter.progress,
+                                       rollout=reporter.rollout,
+                                       priority=priority):
+      if sequencer is not None:
+        ready = sequencer.add(mgmt_command)
+      else:
+        ready = [mgmt_command]
+      for mgmt_command in ready:
+        reporter.add(mgmt_command)
+    reporter.finish()
+  finally:
+    # the coroutine may be cancelled
+    if reporter.progress is not None:
+      reporter.progress.close()
+  return mgmt_commands
+
+
+def run_to_queue(mgmt_commands, fanout, done, per_host=None, progress=None,
+                 rollout=None, priority=None):
+  """This runs the specified commands on a new event loop.
+
+  It is the bridge used by the synchronous Controller methods, which run the
+  event loop on a separate thread and consume the results from 'done'.
+
+  Args:
+    mgmt_commands : An iterable of AsyncCommands
+    fanout        : The maximum number of commands running at once
+    done          : A queue that receives each AsyncCommand as it completes,
+                    an exception if one is raised, and finally None
+    per_host      : The maximum number of commands running at once on each
+                    host, or None for no limit
+    progress      : The _Progress told about started and completed commands,
+                    or None
+    rollout       : The _Rollout deciding when commands may start, or None
+    priority      : A function of an AsyncCommand giving the key by which the
+                    commands are started, lowest first, or None
+  """
+
+  async def drain():
+    async for mgmt_command in schedule(mgmt_commands, fanout, per_host,
+                                       progress, rollout, priority):
+      done.put(mgmt_command)
+
+  try:
+    asyncio.run(drain())
+  except BaseException as ex:
+    done.put(ex)
+  finally:
+    done.put(None)
+
+
+def _probe_fd_limit():
+  """Returns how many probes the file descriptor limit allows, or None."""
+  try:
+    import resource
+  except ImportError:
+    return None
+  soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+  if soft == resource.RLIM_INFINITY:
+    return None
+  return max(1, soft - _PROBE_FD_HEADROOM)
+
+
+async def _probe_one(host, port, timeout):
+  """Returns why a host doesn't accept a connection, None if it does.
+
+  This returns _OUT_OF_FDS if no socket could be opened, which says nothing
+  about the host.
+  """
+  loop = asyncio.get_running_loop()
+  try:
+    transport, _ = await asyncio.wait_for(
+        loop.create_connection(asyncio.Protocol, host, port), timeout)
+  except asyncio.TimeoutError:
+    return 'timed out after {0} seconds'.format(timeout)
+  except (OSError, UnicodeError) as ex:
+    if getattr(ex, 'errno', None) == errno.EMFILE:
+      return _OUT_OF_FDS
+    return str(ex)
+  transport.close()
+  return None
+
+
+async def probe(hosts, port, timeout, fanout):
+  """This checks which hosts accept a TCP connection on a port.
+
+  Args:
+    hosts   : A list of hostnames
+    port    : The port connected to
+    timeout : The seconds each host has to resolve and accept
+    fanout  : The maximum number of connections in flight, lowered to what
+              the file descriptor limit allows
+
+  Returns:
+    A paramgmt.ProbeResult
+  """
+
+  fd_limit = _probe_fd_limit()
+  if fd_limit is not None:
+    fanout = min(fanout, fd_limit)
+  errors = {}
+  pending = iter(hosts)
+  retry = collections.deque()
+  running = {}
+  while True:
+    # fill all free slots, hosts that ran out of descriptors first
+    while len(running) < fanout:
+      if retry:
+        host = retry.popleft()
+      else:
+        host = next(pending, None)
+        if host is None:
+          break
+      running[asyncio.ensure_future(_probe_one(host, port, timeout))] = host
+    if not running:
+      break
+
+    # wait for any probe to finish
+    done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+    for task in done:
+      error = task.result()
+      host = running.pop(task)
+      if error is _OUT_OF_FDS:
+        if running:
+          # retry once the probes in flight free their descriptors, and
+          # keep no more in flight than fit
+          retry.append(host)
+          fanout = len(running)
+          continue
+        error = os.strerror(errno.EMFILE)
+      if error is not None:
+        errors[host] = error
+  live = [host for host in hosts if host not in errors]
+  dead = [host for host in hosts if host in errors]
+  return paramgmt.ProbeResult(live, dead, errors)
+
+
+def probe_hosts(hosts, port, timeout, fanout):
+  """This runs probe() on a new event loop and returns its result."""
+  return asyncio.run(probe(hosts, port, timeout, fanout))
@@ -0,0 +1,307 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""bench: a benchmark of paramgmt against simulated hosts.
+
+The ssh and scp programs are replaced by a local shell stub, so no cluster
+is needed. The stub sleeps for a tunable delay, writes a tunable amount of
+output, and fails or reports an SSH banner error (once per host) for a
+tunable fraction of the hosts. Each operation and host count is measured in
+a fresh Python process so that peak RSS is not carried over between runs:
+
+  python -m paramgmt.bench -m 10 100 1000 10000 -d 0.01
+"""
+
+# Python 3 compatibility
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from . import paramgmt
+
+OPERATIONS = ('remote_command', 'remote_push', 'remote_script')
+HOSTS_DEFAULT = [10, 100, 1000, 10000]
+DELAY_DEFAULT = 0.0
+OUTPUT_SIZE_DEFAULT = 0
+FAILURE_RATE_DEFAULT = 0.0
+BANNER_RATE_DEFAULT = 0.0
+SEED_DEFAULT = 1
+
+# seconds between samples of the number of open file descriptors
+_FD_INTERVAL = 0.01
+
+# every simulated host name contains this, which is how the stub finds it
+_HOST_MARK = 'simhost-'
+
+# the stand-in for ssh and scp, host names select the simulated behavior:
+# simhost-ok-N succeeds, simhost-fail-N fails and simhost-banner-N reports
+# a banner error on its first connection
+_STUB = r'''#!/bin/sh
+host=
+for arg; do
+  case $arg in
+    *{mark}*) host=${{arg%%:*}}; break;;
+  esac
+done
+case $host in
+  *-banner-*)
+    if [ ! -e "{state}/$host" ]; then
+      : > "{state}/$host"
+      echo '{banner}' >&2
+      exit 255
+    fi;;
+esac
+if [ -p /dev/stdin ]; then
+  cat > /dev/null
+fi
+if [ {delay} != 0 ]; then
+  sleep {delay}
+fi
+if [ {size} != 0 ]; then
+  head -c {size} /dev/zero | tr '\0' x
+fi
+case $host in
+  *-fail-*) echo 'simulated failure' >&2; exit 1;;
+esac
+exit 0
+'''
+
+
+def _write_stub(directory, args):
+  """Writes the stub to 'directory' and returns its path."""
+  state = os.path.join(directory, 'state')
+  os.mkdir(state)
+  path = os.path.join(directory, 'fakessh')
+  with open(path, 'w') as fd:
+    fd.write(_STUB.format(mark=_HOST_MARK, state=state, delay=args.delay,
+                          size=args.output_size,
+                          banner=paramgmt.SSH_ERROR_MSGS[0]))
+  os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+  return path
+
+
+def _hosts(count, args):
+  """Returns the simulated host names, failing ones chosen by the seed."""
+  rand = random.Random(args.seed)
+  hosts = []
+  for idx in range(count):
+    pick = rand.random()
+    if pick < args.failure_rate:
+      kind = 'fail'
+    elif pick < args.failure_rate + args.banner_rate:
+      kind = 'banner'
+    else:
+      kind = 'ok'
+    hosts.append('{0}{1}-{2:05d}'.format(_HOST_MARK, kind, idx))
+  return hosts
+
+
+def _count_fds():
+  """Returns the number of open file descriptors of this process."""
+  for fd_dir in ('/proc/self/fd', '/dev/fd'):
+    if os.path.isdir(fd_dir):
+      return len(os.listdir(fd_dir))
+  return None
+
+
+class _FdSampler(threading.Thread):
+  """This tracks the peak number of open file descriptors."""
+
+  def __init__(self):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.peak = _count_fds()
+    self._done = threading.Event()
+
+  def run(self):
+    while not self._done.wait(_FD_INTERVAL):
+      count = _count_fds()
+      if count is not None and count > self.peak:
+        self.peak = count
+
+  def stop(self):
+    self._done.set()
+    self.join()
+
+
+def run_one(operation, count, args):
+  """Runs one operation against 'count' simulated hosts.
+
+  Returns:
+    A dict of the measurements
+  """
+
+  directory = tempfile.mkdtemp(prefix='paramgmt-bench-')
+  try:
+    stub = _write_stub(directory, args)
+    payload = os.path.join(directory, 'payload')
+    with open(payload, 'w') as fd:
+      fd.write('echo ?HOST\n')
+    ctl = paramgmt.Controller(
+        _hosts(count, args), quiet=True, attempts=args.attempts,
+        fanout=args.fanout, engine=args.engine,
+        backoff_base=args.backoff_base, ssh_program=stub, scp_program=stub)
+
+    sampler = _FdSampler()
+    sampler.start()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    if operation == 'remote_command':
+      mgmt_commands = ctl.remote_command(['true'])
+    elif operation == 'remote_push':
+      mgmt_commands = ctl.remote_push([payload], '/tmp/?HOST')
+    else:
+      mgmt_commands = ctl.remote_script([payload])
+    wall = time.time() - start
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+    sampler.stop()
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+  # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+  rss_scale = 1 if sys.platform == 'darwin' else 1024
+  stats = ctl.stats
+  return {'operation': operation,
+          'hosts': count,
+          'engine': args.engine,
+          'fanout': args.fanout,
+          'wall': wall,
+          'throughput': count / wall if wall > 0 else None,
+          'cpu': ((end_usage.ru_utime - usage.ru_utime) +
+                  (end_usage.ru_stime - usage.ru_stime)),
+          'peak_rss': end_usage.ru_maxrss * rss_scale,
+          'peak_fds': sampler.peak,
+          'p50': stats.percentile(50),
+          'p99': stats.percentile(99),
+          'max': stats.max,
+          'retry_time': stats.retry_time,
+          'failed': sum(1 for mgmt_command in mgmt_commands
+                        if mgmt_command.retcode != 0)}
+
+
+def _child_args(operation, count, args):
+  """Returns the command running one measurement in a new process."""
+  return [sys.executable, '-m', 'paramgmt.bench', '--one', operation,
+          str(count), '-d', str(args.delay), '-s', str(args.output_size),
+          '-x', str(args.failure_rate), '-b', str(args.banner_rate),
+          '-a', str(args.attempts), '-n', str(args.fanout),
+          '-e', args.engine, '--backoff_base', str(args.backoff_base),
+          '--seed', str(args.seed)]
+
+
+def _show(result):
+  print('{operation:15s} {hosts:6d} {wall:8.2f} {throughput:9.1f} '
+        '{cpu:7.2f} {rss:8.1f} {peak_fds:5d} {p50:7.3f} {p99:7.3f} '
+        '{max:7.3f} {failed:6d}'.format(
+            rss=result['peak_rss'] / (1024.0 * 1024.0), **result))
+  sys.stdout.flush()
+
+
+def main(args):
+  # the stub must not read this process's stdin
+  devnull = os.open(os.devnull, os.O_RDONLY)
+  os.dup2(devnull, 0)
+  os.close(devnull)
+
+  if args.one is not None:
+    operation, count = args.one
+    print(json.dumps(run_one(operation, int(count), args), sort_keys=True))
+    return 0
+
+  if args.format == 'text':
+    print('{0:15s} {1:>6s} {2:>8s} {3:>9s} {4:>7s} {5:>8s} {6:>5s} {7:>7s} '
+          '{8:>7s} {9:>7s} {10:>6s}'.format(
+              'operation', 'hosts', 'wall s', 'hosts/s', 'cpu s', 'rss MiB',
+              'fds', 'p50 s', 'p99 s', 'max s', 'failed'))
+  for operation in args.operations:
+    for count in args.hosts:
+      output = subprocess.check_output(_child_args(operation, count, args))
+      result = json.loads(output.decode('utf-8'))
+      if args.format == 'jsonl':
+        print(json.dumps(result, sort_keys=True))
+        sys.stdout.flush()
+      else:
+        _show(result)
+  return 0
+
+
+def check_rate(value):
+  fvalue = float(value)
+  if fvalue < 0 or fvalue > 1:
+    msg = 'rate must be between 0 and 1'
+    raise argparse.ArgumentTypeError(msg)
+  return fvalue
+
+
+def check_positive(value):
+  ivalue = int(value)
+  if ivalue < 1:
+    msg = 'value must be greater than 0'
+    raise argparse.ArgumentTypeError(msg)
+  return ivalue
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+    prog='paramgmt.bench', description='paramgmt benchmark',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('-m', '--hosts', type=check_positive, nargs='+',
+                      default=HOSTS_DEFAULT,
+                      help='Numbers of simulated hosts to measure')
+  parser.add_argument('-p', '--operations', nargs='+', choices=OPERATIONS,
+                      default=list(OPERATIONS),
+                      help='Operations to measure')
+  parser.add_argument('-d', '--delay', type=float, default=DELAY_DEFAULT,
+                      help='Seconds each simulated command takes')
+  parser.add_argument('-s', '--output_size', type=int,
+                      default=OUTPUT_SIZE_DEFAULT,
+                      help='Bytes of stdout each simulated command writes')
+  parser.add_argument('-x', '--failure_rate', type=check_rate,
+                      default=FAILURE_RATE_DEFAULT,
+                      help='Fraction of hosts whose command fails')
+  parser.add_argument('-b', '--banner_rate', type=check_rate,
+                      default=BANNER_RATE_DEFAULT,
+                      help='Fraction of hosts that report an SSH banner '
+                      'error on their first connection')
+  parser.add_argument('-a', '--attempts', type=check_positive,
+                      default=paramgmt.ATTEMPTS_DEFAULT,
+                      help='Maximum number of SSH attempts')
+  parser.add_argument('-n', '--fanout', type=check_positive,
+                      default=paramgmt.FANOUT_DEFAULT,
+                      help='Maximum number of hosts worked on at once')
+  parser.add_argument('-e', '--engine', choices=paramgmt.ENGINES,
+                      default=paramgmt.ENGINE_DEFAULT,
+                      help='How child processes are managed')
+  parser.add_argument('--backoff_base', type=float,
+                      default=paramgmt.BACKOFF_BASE_DEFAULT,
+                      help='Seconds to wait before the first retry')
+  parser.add_argument('--seed', type=int, default=SEED_DEFAULT,
+                      help='Seed choosing the failing hosts')
+  parser.add_argument('--format', choices=paramgmt.FORMATS,
+                      default=paramgmt.FORMAT_DEFAULT,
+                      help='Print a table, or one JSON object per run')
+  parser.add_argument('--one', nargs=2, metavar=('OPERATION', 'HOSTS'),
+                      help=argparse.SUPPRESS)
+  sys.exit(main(parser.parse_args()))
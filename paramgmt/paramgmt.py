@@ -17,9 +17,38 @@
 # Python 3 compatibility
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
+import collections
+import errno
+import fnmatch
+import getpass
+import hashlib
+import heapq
+import io
+import json
+import math
+import os
+import posixpath
+import random
+import re
+import select
+import shutil
+import signal
+import tarfile
 import subprocess
 import sys
+import tempfile
 import threading
+import time
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+try:
+  from shlex import quote
+except ImportError:
+  from pipes import quote
 
 try:
   from termcolor import colored
@@ -32,7 +61,112 @@ USER_DEFAULT = None
 PARALLEL_DEFAULT = True
 QUIET_DEFAULT = False
 COLOR_DEFAULT = True
+CAPTURE_LIMIT_DEFAULT = None
+TIMEOUT_DEFAULT = None
+BACKOFF_BASE_DEFAULT = 1.0
+BACKOFF_CAP_DEFAULT = 30.0
+BACKOFF_JITTER_DEFAULT = 1.0
+RETRY_LIMIT_DEFAULT = 32
+CONNECT_RATE_DEFAULT = None
+SCRIPT_CACHE_DEFAULT = None
+SCRIPT_VARS_DEFAULT = False
+SYNC_DEFAULT = False
+TAR_DEFAULT = None
+TAR_LEVEL_DEFAULT = 6
+TAR_CODECS = ('none', 'gz', 'bz2', 'xz')
+PULL_STREAMS_DEFAULT = None
+JOB_DIR_DEFAULT = '~/.paramgmt/jobs'
 ATTEMPTS_DEFAULT = 3
+FANOUT_DEFAULT = 64
+ORDERED_DEFAULT = False
+GROUP_DEFAULT = False
+SLOWEST_DEFAULT = 5
+PROGRESS_DEFAULT = False
+CANARY_DEFAULT = 0
+WAVE_DEFAULT = None
+MAX_FAILURES_DEFAULT = None
+MAX_FAILURE_RATIO_DEFAULT = None
+CANCEL_ON_ABORT_DEFAULT = False
+HEALTH_TTL_DEFAULT = 3600
+DEAD_HOSTS_DEFAULT = 'probe'
+DEAD_HOSTS_POLICIES = ('run', 'probe', 'skip')
+PROBE_PORT_DEFAULT = 22
+PROBE_TIMEOUT_DEFAULT = 2.0
+PROBE_FANOUT_DEFAULT = 1024
+FORMAT_DEFAULT = 'text'
+FORMATS = ('text', 'jsonl')
+MULTIPLEX_DEFAULT = False
+CONTROL_PERSIST_DEFAULT = 300
+RELAY_DEFAULT = 0
+RELAY_AGENT_DEFAULT = False
+ENGINE_DEFAULT = 'thread'
+SSH_PROGRAM_DEFAULT = 'ssh'
+SCP_PROGRAM_DEFAULT = 'scp'
+ENGINES = ('thread', 'asyncio')
+
+# bytes moved per read from, and write to, a child process
+_READ_CHUNK = 65536
+_PIPE_CHUNK = getattr(select, 'PIPE_BUF', 512)
+
+# seconds to wait for the output of a killed process to be closed
+_KILL_GRACE = 1.0
+
+# seconds between checks whether a process that closed its output exited
+_EXIT_POLL = 0.05
+
+# a clock that is unaffected by system time changes where available
+_now = getattr(time, 'monotonic', time.time)
+
+# the tar option that decompresses each codec
+_TAR_FLAGS = {'none': '', 'gz': 'z', 'bz2': 'j', 'xz': 'J'}
+
+# how a host reports that a bundle is not in its remote script cache
+_SCRIPT_CACHE_MISS = 'paramgmt: script cache miss'
+_SCRIPT_CACHE_MISS_CODE = 255
+
+# how a host reports the state of a detached job on the first line of stderr:
+# done, still running, ended without a result (like after a reboot), or
+# never started
+_JOB_DONE = 'paramgmt: job done'
+_JOB_RUNNING = 'paramgmt: job running'
+_JOB_LOST = 'paramgmt: job lost'
+_JOB_MISSING = 'paramgmt: job not found'
+_JOB_PENDING_CODE = 254
+
+# a job id, which names its directory on each host
+_JOB_ID_RE = re.compile(r'^[\w.-]+$')
+
+# how a pulled file that doesn't match its remote checksum is reported
+_CHECKSUM_MISMATCH = 'paramgmt: checksum mismatch'
+_CHECKSUM_MISMATCH_CODE = 1
+
+# a line listing a remote file for a streamed pull:
+# <root index> <size> <sha256>  <path>
+_PULL_LIST_RE = re.compile(r'^(\d+) (\d+) ([0-9a-f]{64}) [ *](.*)$')
+
+# one host expression in a line, brackets may hold commas
+_HOST_TERM_RE = re.compile(r'(?:[^\s,\[]|\[[^\]]*\])+')
+
+# a numeric range in a host expression, like [0001-4096] or [1-3,7]
+_HOST_RANGE_RE = re.compile(r'\[(\d+(?:-\d+)?(?:,\d+(?:-\d+)?)*)\]')
+
+# the lines of a host file that aren't host expressions
+_HOST_INCLUDE_RE = re.compile(r'^include\s+(.+)$')
+_HOST_GROUP_RE = re.compile(r'^@([\w.-]+)\s*=(.*)$')
+
+# a template variable: ?HOST, ?USER, ?INDEX or a host variable like ?{rack}
+_TEMPLATE_RE = re.compile(r'\?(HOST|USER|INDEX)|\?\{(\w+)\}')
+
+# seconds between checks for a free retry slot on the asyncio engine
+_RETRY_POLL = 0.1
+
+# seconds between progress redraws on a terminal, and between progress
+# lines otherwise
+_PROGRESS_REDRAW = 0.1
+_PROGRESS_LOG = 10.0
+
+# bytes of a stream written to a file that are also kept in memory
+_PEEK_SIZE = 1024
 
 # error message from SSH indicating that it couldn't connect
 SSH_ERROR_MSGS = [
@@ -40,10 +174,135 @@ SSH_ERROR_MSGS = [
   'ssh_exchange_identification: Connection closed by remote host',
   'ssh_exchange_identification: read: Connection reset by peer']
 
+# error messages from SSH indicating that a host couldn't be reached at all
+_UNREACHABLE_MSGS = [
+  'ssh: connect to host',
+  'ssh: Could not resolve hostname']
+
+# why a command was skipped
+_SKIP_ABORTED = 'rollout aborted'
+_SKIP_DEAD = 'unreachable, per the health cache'
+
+
+def _load_aio():
+  """This imports the asyncio engine, which requires Python 3.8+."""
+  if sys.version_info < (3, 8):
+    raise EnvironmentError('the asyncio engine requires Python 3.8+')
+  from . import aio
+  return aio
+
+
+def _quote_path(path):
+  """Quotes a path for a remote shell, leaving a leading '~/' expandable."""
+  if path == '~':
+    return path
+  if path.startswith('~/'):
+    return '~/' + quote(path[2:])
+  return quote(path)
+
+
+def _read_text(filename):
+  """Returns the contents of a text file."""
+  with open(filename, 'r') as fd:
+    return fd.read()
+
+
+def _file_digest(filename):
+  """Returns the hex SHA-256 of a file's contents."""
+  digest = hashlib.sha256()
+  with open(filename, 'rb') as fd:
+    while True:
+      block = fd.read(_READ_CHUNK)
+      if not block:
+        break
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def _script_bundle(script_names, read):
+  """This joins scripts into the text run by remote_script().
+
+  Args:
+    script_names : The names of the scripts, in order
+    read         : A function returning the text of a script given its name
+
+  Returns:
+    The text of all scripts, each ending with a newline
+  """
+
+  all_script = ''
+  for script_name in script_names:
+    all_script += read(script_name)
+    if all_script[-1:] != '\n':
+      all_script += '\n'
+  if not all_script:
+    all_script = ':'
+  return all_script
+
+
+class _Template(object):
+  """A text with variables, parsed once and rendered for each host.
+
+  The variables are ?HOST, ?USER (the remote user), ?INDEX (the position of
+  the host) and ?{name}, a variable of the host from its Inventory.
+  """
+
+  def __init__(self, text, names=None, strict=True):
+    """Constructor for _Template.
+
+    Args:
+      text   : The text
+      names  : The names of the variables replaced, others are left alone,
+               or None for all
+      strict : Whether a variable without a value is an error when
+               rendering, otherwise it is left alone
+    """
+
+    self.text = text
+    self.strict = strict
+    self._parts = []
+    self._slots = []
+    self.names = set()
+    pos = 0
+    for match in _TEMPLATE_RE.finditer(text):
+      name = match.group(1) or match.group(2)
+      if names is not None and name not in names:
+        continue
+      self._parts.append(text[pos:match.start()])
+      self._slots.append((len(self._parts), name))
+      self._parts.append(match.group(0))
+      self.names.add(name)
+      pos = match.end()
+    self._parts.append(text[pos:])
+
+  def render(self, values):
+    """Returns the text with the variables replaced by 'values'."""
+    if not self._slots:
+      return self.text
+    parts = list(self._parts)
+    for idx, name in self._slots:
+      if name in values:
+        parts[idx] = values[name]
+      elif self.strict:
+        raise ValueError('no value of ?{{{0}}} for {1}'.format(
+            name, values.get('HOST')))
+    return ''.join(parts)
+
+
+def _templates(texts):
+  """Returns a _Template of each text."""
+  return [_Template(text) for text in texts]
+
+
+def _is_tty(stream):
+  """Returns whether a stream is an interactive terminal."""
+  isatty = getattr(stream, 'isatty', None)
+  return isatty is not None and isatty()
+
 
 def _should_color(want_to_color):
   """This function turns 'want_to_color' into 'should_color'."""
-  return want_to_color and CAN_COLOR and sys.stdout.isatty()
+  return want_to_color and CAN_COLOR and _is_tty(sys.stdout)
 
 
 def all_success(mgmt_commands):
@@ -62,8 +321,346 @@ def all_success(mgmt_commands):
   return True
 
 
+def job_state(mgmt_command):
+  """Returns the state of a job on a host.
+
+  Args:
+    mgmt_command : A Command returned by Controller.poll_job() or
+                   Controller.collect_job()
+
+  Returns:
+    'done', 'running', 'lost' if it ended without a result, 'missing' if it
+    was never started or was removed, or None if the host didn't answer,
+    like when it was unreachable or timed out
+  """
+
+  if (mgmt_command.retcode is None or mgmt_command.timed_out or
+      mgmt_command.cancelled or mgmt_command.skipped):
+    return None
+  stderr = mgmt_command.stderr
+  for state, msg in (('done', _JOB_DONE), ('running', _JOB_RUNNING),
+                     ('lost', _JOB_LOST), ('missing', _JOB_MISSING)):
+    if stderr == msg or stderr.startswith(msg + '\n'):
+      return state
+  return None
+
+
+def group_results(mgmt_commands):
+  """Groups completed commands by identical results.
+
+  Args:
+    mgmt_commands : An iterable of completed Command objects
+
+  Returns:
+    A list of Group objects in order of first appearance
+  """
+
+  grouper = _Grouper()
+  for mgmt_command in mgmt_commands:
+    grouper.add(mgmt_command)
+  return grouper.groups()
+
+
+def _compact_hosts(hosts):
+  """Returns a short text naming hosts, like 'node[01-03,07].lab,db'.
+
+  Hosts that differ only in a number are folded into a range expression.
+  Numbers with leading zeros are only folded with numbers of the same width.
+  """
+
+  numbered = collections.OrderedDict()
+  for host in hosts:
+    match = re.match(r'^(.*?)(\d+)(\D*)$', host)
+    if match is None:
+      numbered.setdefault((host, None), [])
+    else:
+      prefix, digits, suffix = match.groups()
+      numbered.setdefault((prefix, suffix), []).append(digits)
+
+  names = []
+  for (prefix, suffix), all_digits in numbered.items():
+    if suffix is None:
+      names.append(prefix)
+      continue
+    padded = set(len(digits) for digits in all_digits
+                 if len(digits) > 1 and digits[0] == '0')
+    ranges = collections.OrderedDict()
+    for digits in all_digits:
+      width = len(digits) if len(digits) in padded else 0
+      ranges.setdefault(width, set()).add(int(digits))
+    for width, numbers in ranges.items():
+      numbers = sorted(numbers)
+      if len(numbers) == 1:
+        names.append('{0}{1}{2}'.format(
+            prefix, str(numbers[0]).zfill(width), suffix))
+        continue
+      spans = []
+      first = last = numbers[0]
+      for number in numbers[1:] + [None]:
+        if number is not None and number == last + 1:
+          last = number
+          continue
+        if first == last:
+          spans.append(str(first).zfill(width))
+        else:
+          spans.append('{0}-{1}'.format(str(first).zfill(width),
+                                        str(last).zfill(width)))
+        first = last = number
+      names.append('{0}[{1}]{2}'.format(prefix, ','.join(spans), suffix))
+  return ','.join(names)
+
+
+def _expand_ranges(term):
+  """Yields the hosts of one host expression, expanding its ranges."""
+  match = _HOST_RANGE_RE.search(term)
+  if match is None:
+    yield term
+    return
+  prefix = term[:match.start()]
+  suffix = term[match.end():]
+  for span in match.group(1).split(','):
+    first, _, last = span.partition('-')
+    if not last:
+      last = first
+    if int(last) < int(first):
+      raise ValueError('bad host range: {0}'.format(span))
+    # numbers with leading zeros keep their width
+    width = len(first) if first.startswith('0') else 0
+    for number in range(int(first), int(last) + 1):
+      for rest in _expand_ranges(suffix):
+        yield '{0}{1}{2}'.format(prefix, str(number).zfill(width), rest)
+
+
+def expand_hosts(expression):
+  """Yields the hosts named by a host expression, one at a time.
+
+  The expression is a comma or whitespace separated list of names, in which
+  numeric ranges in brackets are expanded. 'node[01-03,07].lab,db' yields
+  node01.lab, node02.lab, node03.lab, node07.lab and db. Numbers with
+  leading zeros keep their width, and names may hold several ranges.
+
+  Args:
+    expression : The host expression
+  """
+
+  for term in _HOST_TERM_RE.findall(expression):
+    for host in _expand_ranges(term):
+      yield host
+
+
+def _is_glob(host):
+  return '*' in host or '?' in host
+
+
+class Inventory(object):
+  """A set of hosts described by host expressions, expanded lazily.
+
+  Each line given to an Inventory is one of:
+
+    EXPR            adds the hosts of EXPR
+    EXPR NAME=VALUE adds the hosts of EXPR, setting their variable NAME
+    -EXPR           excludes the hosts of EXPR, wherever they are added
+    &EXPR           keeps only the hosts that are also in EXPR
+    @NAME = EXPR    defines the group NAME, whose hosts EXPR names as @NAME
+    include FILE    reads the lines of FILE, relative to the current file
+
+  EXPR is a host expression (see expand_hosts()) that may also refer to
+  groups. Names with '*' or '?' are glob patterns in excluded and kept
+  expressions. Text after a '#' is a comment. Host variables are used as
+  ?{NAME} in the arguments, paths and scripts of Controller operations.
+
+  Iterating yields each host once, in the order first added, without
+  building a list of the hosts, so an Inventory can be given to a
+  Controller as its hosts. It may be iterated again for each operation.
+  It is also a sequence like the list of its hosts: len() and indexing
+  expand the hosts once and keep the list until more lines are added.
+  """
+
+  def __init__(self, lines=None):
+    """Constructor for Inventory.
+
+    Args:
+      lines : An iterable of lines to add, or None
+    """
+
+    self._added = []
+    self._excluded = []
+    self._kept = []
+    self._groups = {}
+    self._variables = []
+    self._index = None
+    self._list = None
+    self._reading = []
+    if lines is not None:
+      self.extend(lines)
+
+  def extend(self, lines, directory=None):
+    """Adds lines, or the lines of another Inventory.
+
+    Args:
+      lines     : An iterable of lines, or an Inventory
+      directory : The directory included files are relative to, or None for
+                  the current directory
+    """
+
+    if isinstance(lines, Inventory):
+      self._added.extend(lines._added)
+      self._excluded.extend(lines._excluded)
+      self._kept.extend(lines._kept)
+      self._groups.update(lines._groups)
+      self._variables.extend(lines._variables)
+      self._index = None
+      self._list = None
+      return
+    for line in lines:
+      self.add(line, directory)
+
+  def add(self, line, directory=None):
+    """Adds one line.
+
+    Args:
+      line      : The line
+      directory : The directory an included file is relative to, or None
+                  for the current directory
+    """
+
+    idx = line.find('#')
+    if idx >= 0:
+      line = line[:idx]
+    line = line.strip()
+    if not line:
+      return
+    self._list = None
+    include = _HOST_INCLUDE_RE.match(line)
+    group = _HOST_GROUP_RE.match(line)
+    if include is not None:
+      filename = os.path.expanduser(include.group(1).strip())
+      if directory:
+        filename = os.path.join(directory, filename)
+      self.read(filename)
+    elif group is not None:
+      self._groups[group.group(1)] = _HOST_TERM_RE.findall(group.group(2))
+    elif line.startswith('-'):
+      self._excluded.extend(_HOST_TERM_RE.findall(line[1:]))
+    elif line.startswith('&'):
+      self._kept.append(_HOST_TERM_RE.findall(line[1:]))
+    else:
+      terms = []
+      variables = {}
+      for term in _HOST_TERM_RE.findall(line):
+        name, equals, value = term.partition('=')
+        if equals:
+          variables[name] = value
+        else:
+          terms.append(term)
+      self._added.extend(terms)
+      if variables:
+        self._variables.append((terms, variables))
+        self._index = None
+
+  def read(self, filename):
+    """Adds the lines of a file."""
+    path = os.path.realpath(filename)
+    if path in self._reading:
+      raise ValueError('host file includes itself: {0}'.format(filename))
+    self._reading.append(path)
+    try:
+      with open(filename, 'r') as fd:
+        self.extend(fd, os.path.dirname(filename))
+    finally:
+      self._reading.pop()
+
+  def _hosts(self, terms, groups=()):
+    """Yields the hosts and glob patterns of some host expressions."""
+    for term in terms:
+      if not term.startswith('@'):
+        for host in _expand_ranges(term):
+          yield host
+        continue
+      name = term[1:]
+      if name not in self._groups:
+        raise ValueError('unknown host group: {0}'.format(name))
+      if name in groups:
+        raise ValueError('host group contains itself: {0}'.format(name))
+      for host in self._hosts(self._groups[name], groups + (name,)):
+        yield host
+
+  def _matcher(self, terms):
+    """Returns a function telling whether a host is in some expressions."""
+    names = set()
+    patterns = []
+    for host in self._hosts(terms):
+      if _is_glob(host):
+        patterns.append(fnmatch.translate(host))
+      else:
+        names.add(host)
+    if not patterns:
+      return names.__contains__
+    regex = re.compile('|'.join(patterns))
+    return lambda host: host in names or regex.match(host) is not None
+
+  def _expand(self):
+    """Yields each host once, in the order first added."""
+    excluded = self._matcher(self._excluded)
+    kept = [self._matcher(terms) for terms in self._kept]
+    seen = set()
+    for host in self._hosts(self._added):
+      if _is_glob(host):
+        raise ValueError('glob patterns only exclude or keep hosts: {0}'
+                         .format(host))
+      if host in seen:
+        continue
+      seen.add(host)
+      if excluded(host):
+        continue
+      if all(match(host) for match in kept):
+        yield host
+
+  def _expanded(self):
+    """Returns the list of the hosts, expanding them on first use."""
+    if self._list is None:
+      self._list = list(self._expand())
+    return self._list
+
+  def __iter__(self):
+    if self._list is not None:
+      return iter(self._list)
+    return self._expand()
+
+  def variables(self, host):
+    """Returns a dict of the variables set for a host.
+
+    The hosts of all lines setting variables are expanded on the first
+    call, later lines overriding earlier ones.
+    """
+
+    if self._index is None:
+      index = {}
+      for terms, variables in self._variables:
+        for name in self._hosts(terms):
+          index.setdefault(name, {}).update(variables)
+      self._index = index
+    return self._index.get(host, {})
+
+  def __len__(self):
+    return len(self._expanded())
+
+  def __getitem__(self, idx):
+    """Returns a host, or a list of hosts for a slice."""
+    return self._expanded()[idx]
+
+  def __bool__(self):
+    if self._list is not None:
+      return bool(self._list)
+    for _ in self._expand():
+      return True
+    return False
+
+  __nonzero__ = __bool__
+
+
 def parse_file(filename):
-  """This function parses a file to generate a list of lines.
+  """This function parses a file of host expressions.
 
   This function wraps the parse_stream() function by opening
   the specified file first.
@@ -72,428 +669,3437 @@ def parse_file(filename):
     filename : The name of the file to be parsed
 
   Returns:
-    A list of lines.
+    An Inventory of the hosts.
   """
 
-  fd = open(filename, 'r')
-  lines = parse_stream(fd)
-  fd.close()
-  return lines
+  inventory = Inventory()
+  inventory.read(filename)
+  return inventory
 
 
 def parse_stream(stream):
-  """This function parses the contents of a stream to generate a list of lines.
+  """This function parses the contents of a stream of host expressions.
 
   This function removes comments delimited by '#', ingores empty
-  lines, and leading and trailing whitespace.
+  lines, and leading and trailing whitespace. The lines are read right
+  away, but the hosts are only expanded when the Inventory is iterated,
+  see Inventory for the syntax.
 
   Args:
     stream : A file that has been open()'d
 
   Returns:
-    A list of lines.
+    An Inventory of the hosts.
   """
 
-  lines = []
-  for line in stream:
-    idx = line.find('#')
-    if idx >= 0:
-      line = line[:idx]
-    line = line.strip()
-    if line:
-      lines.append(line.strip())
-  return lines
+  inventory = Inventory()
+  name = getattr(stream, 'name', None)
+  directory = None
+  if isinstance(name, str) and not name.startswith('<'):
+    directory = os.path.dirname(name)
+  inventory.extend(stream, directory)
+  return inventory
+
+
+class _RetryPolicy(object):
+  """This decides when a command may retry after an SSH connection error.
+
+  Retries back off exponentially with jitter, so that hosts that failed
+  together do not retry together, and a budget limits how many retries may
+  be running at once across all commands sharing the policy.
+  """
+
+  def __init__(self, base=0, cap=0, jitter=0, limit=None):
+    """Constructor for _RetryPolicy.
+
+    Args:
+      base   : The delay in seconds before the first retry
+      cap    : The maximum delay in seconds
+      jitter : The fraction of each delay that is randomized, 0 to 1
+      limit  : The maximum number of retries running at once, or None
+    """
+
+    self.base = base
+    self.cap = cap
+    self.jitter = jitter
+    self.limit = limit
+    self._running = 0
+    self._cond = threading.Condition()
+
+  def delay(self, attempts):
+    """Returns the seconds to wait after the given number of attempts."""
+    delay = min(self.cap, self.base * 2 ** (attempts - 1))
+    return delay * (1 - self.jitter * random.random())
+
+  def try_acquire(self):
+    """Takes a retry slot if one is free, returning whether it did."""
+    with self._cond:
+      if self.limit is not None and self._running >= self.limit:
+        return False
+      self._running += 1
+      return True
+
+  def acquire(self):
+    """Takes a retry slot, waiting for one to become free."""
+    with self._cond:
+      while self.limit is not None and self._running >= self.limit:
+        self._cond.wait()
+      self._running += 1
+
+  def release(self):
+    """Returns a retry slot."""
+    with self._cond:
+      self._running -= 1
+      self._cond.notify()
+
+
+class _TokenBucket(object):
+  """This limits the rate at which processes are launched.
+
+  Tokens accumulate at 'rate' per second up to 'burst'. Each launch takes a
+  token, and launches that find the bucket empty are spaced out evenly
+  behind the ones already waiting.
+  """
+
+  def __init__(self, rate, burst=1):
+    self.rate = float(rate)
+    self.burst = burst
+    self._tokens = burst
+    self._last = _now()
+    self._lock = threading.Lock()
+
+  def reserve(self):
+    """Takes a token, returning the seconds to wait before using it."""
+    with self._lock:
+      now = _now()
+      self._tokens = min(self.burst,
+                         self._tokens + (now - self._last) * self.rate)
+      self._last = now
+      self._tokens -= 1
+      if self._tokens >= 0:
+        return 0
+      return -self._tokens / self.rate
+
+
+def _script_cache_missed(mgmt_command):
+  """Returns whether a cached remote_script() found no bundle on the host."""
+  return (mgmt_command.retcode == _SCRIPT_CACHE_MISS_CODE and
+          mgmt_command.stderr.startswith(_SCRIPT_CACHE_MISS))
+
+
+def _retried(mgmt_command):
+  """Returns whether a failed command is retried by its operation.
+
+  A cached remote_script() that found no bundle uploads it, and a relayed
+  push is retried from this machine.
+  """
+  if mgmt_command.retcode == 0:
+    return False
+  return (_script_cache_missed(mgmt_command) or
+          mgmt_command.source is not None)
+
+
+def _wave_size(wave, total):
+  """Returns the number of hosts in a wave given as a count or 'N%'."""
+  wave = str(wave)
+  if wave.endswith('%'):
+    if total is None:
+      raise ValueError('percentage waves require a list of hosts')
+    return max(1, int(math.ceil(float(wave[:-1]) / 100.0 * total)))
+  return int(wave)
+
+
+class _Rollout(object):
+  """This launches an operation in waves and aborts it on too many failures.
+
+  A canary wave runs first, then waves of a fixed size or a percentage of
+  the hosts. Each wave starts once the previous one has completed. Once the
+  failures exceed a limit, no more commands are started, and the running
+  ones are cancelled if asked to.
+  """
+
+  def __init__(self, total=None, canary=0, wave=None, max_failures=None,
+               max_failure_ratio=None, cancel=False):
+    """Constructor for _Rollout.
+
+    Args:
+      total             : The number of hosts, needed for percentage waves
+      canary            : The number of hosts in the first wave, 0 for none
+      wave              : The size of the following waves as a count or a
+                          string 'N%', or None for all remaining hosts at once
+      max_failures      : The failures tolerated before aborting, or None
+      max_failure_ratio : The fraction of completed commands allowed to fail
+                          before aborting, judged once 1/max_failure_ratio
+                          commands completed, or None
+      cancel            : Whether aborting kills the running commands
+    """
+
+    self._wave = None if wave is None else _wave_size(wave, total)
+    if canary:
+      self._wave_end = int(canary)
+    else:
+      self._wave_end = self._wave
+    self.max_failures = max_failures
+    self.max_failure_ratio = max_failure_ratio
+    self.cancel = cancel
+    self.started = 0
+    self.completed = 0
+    self.failures = 0
+    self.aborted = None
+
+  def may_start(self, running):
+    """Returns whether another command may start.
+
+    Args:
+      running : The number of commands running
+    """
+
+    if self.aborted is not None:
+      return False
+    if self._wave_end is None or self.started < self._wave_end:
+      return True
+    if running:
+      return False
+    # the wave has completed, open the next one
+    if self._wave is None:
+      self._wave_end = None
+    else:
+      self._wave_end += self._wave
+    return True
+
+  def record(self, mgmt_command):
+    """Counts a completed command, returning whether to abort now."""
+    if mgmt_command.skipped or _retried(mgmt_command):
+      # known to be unreachable, or not done with the host yet, it tells
+      # nothing about the rollout
+      return False
+    self.completed += 1
+    if mgmt_command.retcode == 0:
+      return False
+    self.failures += 1
+    if self.aborted is not None:
+      return False
+    if self.max_failures is not None and self.failures > self.max_failures:
+      self.aborted = '{0} failures exceed the limit of {1}'.format(
+          self.failures, self.max_failures)
+    elif (self.max_failure_ratio is not None and self._ratio_applies() and
+          self.failures > self.max_failure_ratio * self.completed):
+      self.aborted = '{0} of {1} completed failed, above {2:.0%}'.format(
+          self.failures, self.completed, self.max_failure_ratio)
+    return self.aborted is not None
+
+  def _ratio_applies(self):
+    """Returns whether enough commands completed to judge the failure ratio.
+
+    That is once a single failure stays within the ratio, so a failure among
+    the first few hosts doesn't abort the whole operation.
+    """
+    return (self.max_failure_ratio == 0 or
+            self.completed * self.max_failure_ratio >= 1)
+
+
+class _HostSlots(object):
+  """This hands out commands to start, limiting how many run on each host.
+
+  Commands whose host already has 'per_host' commands running are set aside
+  and handed out first once one of that host's commands completes.
+  """
+
+  def __init__(self, mgmt_commands, per_host=None, progress=None,
+               rollout=None, priority=None):
+    """Constructor for _HostSlots.
+
+    Args:
+      mgmt_commands : An iterable of Commands
+      per_host      : The maximum number of running commands per host, or
+                      None for no limit
+      progress      : The _Progress told about started and completed
+                      commands, or None
+      rollout       : The _Rollout deciding when commands may start, or None
+      priority      : A function of a Command giving the key by which the
+                      commands are started, lowest first, or None to start
+                      them as given. All commands are then created up front.
+    """
+
+    self._pending = enumerate(mgmt_commands)
+    if priority is not None:
+      self._pending = iter(sorted(self._pending,
+                                  key=lambda item: priority(item[1])))
+    self._per_host = per_host
+    self._progress = progress
+    self._rollout = rollout
+    self._deferred = collections.deque()
+    self._running = collections.defaultdict(int)
+    self._active = set()
+    self._exhausted = False
+
+  def _admit(self, mgmt_command):
+    if (self._per_host is not None and
+        self._running[mgmt_command.host] >= self._per_host):
+      return False
+    self._running[mgmt_command.host] += 1
+    self._active.add(mgmt_command)
+    if self._rollout is not None:
+      self._rollout.started += 1
+    if self._progress is not None:
+      self._progress.started(mgmt_command)
+    return True
+
+  def take(self):
+    """Returns the next command that may start, with its index set, or None.
+
+    None means that every remaining command waits for a running one, or
+    that the rollout was aborted.
+    """
+
+    if (self._rollout is not None and
+        not self._rollout.may_start(len(self._active))):
+      return None
+    for _ in range(len(self._deferred)):
+      mgmt_command = self._deferred.popleft()
+      if self._admit(mgmt_command):
+        return mgmt_command
+      self._deferred.append(mgmt_command)
+    while not self._exhausted:
+      try:
+        idx, mgmt_command = next(self._pending)
+      except StopIteration:
+        self._exhausted = True
+        break
+      mgmt_command.index = idx
+      if self._admit(mgmt_command):
+        return mgmt_command
+      self._deferred.append(mgmt_command)
+    return None
+
+  def release(self, mgmt_command):
+    """Records that a command handed out by take() has completed."""
+    self._running[mgmt_command.host] -= 1
+    self._active.discard(mgmt_command)
+    if self._progress is not None:
+      self._progress.completed(mgmt_command)
+    if self._rollout is not None and self._rollout.record(mgmt_command):
+      if self._rollout.cancel:
+        for running in self._active:
+          running.cancel()
+
+  def remaining(self):
+    """Yields the commands never started, marked as skipped.
+
+    Call this once take() returns None and no command is running.
+    """
+
+    while self._deferred:
+      mgmt_command = self._deferred.popleft()
+      mgmt_command.skip(_SKIP_ABORTED)
+      yield mgmt_command
+    for idx, mgmt_command in self._pending:
+      mgmt_command.index = idx
+      mgmt_command.skip(_SKIP_ABORTED)
+      yield mgmt_command
+
+
+class _Progress(object):
+  """This shows how far an operation has come while it runs.
+
+  The counters are updated as commands start and complete, and a separate
+  thread draws them at a bounded rate: redrawn in place on a terminal,
+  otherwise as a log line every so often. Progress is written to stderr so
+  that it never mixes with results on stdout.
+  """
+
+  def __init__(self, total=None, stream=None, interval=None):
+    """Constructor for _Progress.
+
+    Args:
+      total    : The number of results expected, or None if not known
+      stream   : The stream written to, stderr if None
+      interval : The seconds between draws, or None for a default that
+                 depends on whether the stream is a terminal
+    """
+
+    self._stream = sys.stderr if stream is None else stream
+    self._tty = _is_tty(self._stream)
+    if interval is None:
+      interval = _PROGRESS_REDRAW if self._tty else _PROGRESS_LOG
+    self._interval = interval
+    self.total = total
+    self.succeeded = 0
+    self.failed = 0
+    self._running = set()
+    self._start = _now()
+    self._lock = threading.Lock()
+    self._output_lock = threading.Lock()
+    self._done = threading.Event()
+    self._drawn = False
+    self._thread = threading.Thread(target=self._draw_loop)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def started(self, mgmt_command):
+    """Records that the scheduler started a command."""
+    with self._lock:
+      self._running.add(mgmt_command)
+
+  def completed(self, mgmt_command):
+    """Records that a command the scheduler started has completed."""
+    with self._lock:
+      self._running.discard(mgmt_command)
+
+  def reported(self, mgmt_command):
+    """Records the result of a command."""
+    with self._lock:
+      if mgmt_command.retcode == 0:
+        self.succeeded += 1
+      else:
+        self.failed += 1
+
+  def line(self):
+    """Returns the text of the current progress."""
+    with self._lock:
+      elapsed = _now() - self._start
+      done = self.succeeded + self.failed
+      running = len(self._running)
+      retrying = sum(1 for mgmt_command in self._running
+                     if mgmt_command.attempts > 1)
+    rate = done / elapsed if elapsed > 0 else 0.0
+    text = '[{0:.0f}s] {1}'.format(elapsed, done)
+    if self.total is not None:
+      text += '/{0}'.format(self.total)
+    text += ' done ({0} succeeded, {1} failed), {2} running'.format(
+        self.succeeded, self.failed, running)
+    if retrying:
+      text += ' ({0} retrying)'.format(retrying)
+    if self.total is not None:
+      queued = max(0, self.total - done - running)
+      text += ', {0} queued'.format(queued)
+    text += ', {0:.1f} hosts/s'.format(rate)
+    if self.total is not None and rate > 0 and done < self.total:
+      text += ', ETA {0:.0f}s'.format((self.total - done) / rate)
+    return text
+
+  def _draw(self):
+    """Draws the progress, the caller holds _output_lock."""
+    if self._tty:
+      self._stream.write('\r\x1b[K' + self.line())
+    else:
+      self._stream.write(self.line() + '\n')
+    self._stream.flush()
+    self._drawn = True
+
+  def _draw_loop(self):
+    while not self._done.wait(self._interval):
+      with self._output_lock:
+        self._draw()
+
+  def print_above(self, text):
+    """Prints to stdout without garbling a progress line on the terminal."""
+    with self._output_lock:
+      redraw = self._tty and self._drawn
+      if redraw:
+        self._stream.write('\r\x1b[K')
+        self._stream.flush()
+      print(text)
+      sys.stdout.flush()
+      if redraw:
+        self._draw()
+
+  def close(self):
+    """Stops drawing and shows the final progress, if not done already."""
+    if self._done.is_set():
+      return
+    self._done.set()
+    self._thread.join()
+    with self._output_lock:
+      if self._tty:
+        self._stream.write('\r\x1b[K')
+      self._stream.write(self.line() + '\n')
+      self._stream.flush()
+
+
+class _Sequencer(object):
+  """This puts completed commands back into the order they were started."""
+
+  def __init__(self):
+    self._finished = {}
+    self._next_idx = 0
+
+  def add(self, mgmt_command):
+    """Adds a completed command.
+
+    Args:
+      mgmt_command : A completed Command with its index set
+
+    Returns:
+      A list of Commands now ready to be reported, in order
+    """
+
+    self._finished[mgmt_command.index] = mgmt_command
+    ready = []
+    while self._next_idx in self._finished:
+      ready.append(self._finished.pop(self._next_idx))
+      self._next_idx += 1
+    return ready
+
+
+# the _now() times of one attempt of a Command, first_byte is None if the
+# attempt wrote no output
+AttemptTime = collections.namedtuple('AttemptTime',
+                                     ['spawn', 'first_byte', 'end'])
+
+
+class Job(object):
+  """A handle on a job started detached by Controller.remote_job().
+
+  Only the id is needed to poll or collect the job later, from any
+  Controller of the same hosts and user, also in another process.
+  """
+
+  def __init__(self, job_id, launches):
+    """Constructor for Job.
+
+    Args:
+      job_id   : The id of the job
+      launches : The Commands that started the job on each host
+    """
+
+    self.id = job_id
+    self.launches = launches
+
+  @property
+  def hosts(self):
+    """The hosts the job was started on."""
+    return [mgmt_command.host for mgmt_command in self.launches
+            if mgmt_command.retcode == 0]
+
+
+# the outcome of Controller.probe(): the hosts that accepted a connection and
+# those that didn't, both in host order, and why each dead host is dead
+ProbeResult = collections.namedtuple('ProbeResult', ['live', 'dead', 'errors'])
+
+
+class Stats(object):
+  """Timing statistics of the commands of an operation.
+
+  Commands are added as they complete. Latency is the time from a command
+  being started by the scheduler to its completion, retries included.
+  """
+
+  def __init__(self, slowest=SLOWEST_DEFAULT):
+    """Constructor for Stats.
+
+    Args:
+      slowest : The number of slowest hosts to keep
+    """
+
+    self._slowest_count = slowest
+    self._latencies = []
+    self._slowest = []
+    self.count = 0
+    self.retried = 0
+    self.retry_time = 0.0
+    self.queue_time = 0.0
+
+  def add(self, mgmt_command):
+    """Adds a completed command."""
+    latency = mgmt_command.latency
+    if latency is None:
+      return
+    self.count += 1
+    self._latencies.append(latency)
+    self.queue_time += mgmt_command.queue_time
+    if mgmt_command.attempts > 1:
+      self.retried += 1
+      self.retry_time += mgmt_command.retry_time
+    entry = (latency, mgmt_command.host)
+    if len(self._slowest) < self._slowest_count:
+      heapq.heappush(self._slowest, entry)
+    elif self._slowest and entry > self._slowest[0]:
+      heapq.heapreplace(self._slowest, entry)
+
+  def percentile(self, pct):
+    """Returns the latency below which 'pct' percent of hosts finished.
+
+    This uses the nearest rank, None if no command has completed.
+    """
+
+    if not self._latencies:
+      return None
+    latencies = sorted(self._latencies)
+    rank = int(math.ceil(pct / 100.0 * len(latencies)))
+    return latencies[max(0, rank - 1)]
+
+  @property
+  def max(self):
+    return max(self._latencies) if self._latencies else None
+
+  def slowest(self):
+    """Returns the slowest hosts as (latency, host) tuples, slowest first."""
+    return sorted(self._slowest, reverse=True)
+
+  def as_dict(self):
+    """Returns the statistics as a dict for export."""
+    return {'count': self.count,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+            'retried': self.retried,
+            'retry_time': self.retry_time,
+            'queue_time': self.queue_time,
+            'slowest': [{'host': host, 'latency': latency}
+                        for latency, host in self.slowest()]}
+
+  def summary(self):
+    """Returns the lines printed in the run summary."""
+    if not self.count:
+      return []
+    text = ['latency: p50 {0:.2f}s, p90 {1:.2f}s, p99 {2:.2f}s, '
+            'max {3:.2f}s'.format(self.percentile(50), self.percentile(90),
+                                  self.percentile(99), self.max)]
+    if self.retried:
+      text.append('retries: {0} hosts, {1:.2f}s in total'.format(
+          self.retried, self.retry_time))
+    if self.count > 1:
+      text.append('slowest hosts:')
+      for latency, host in self.slowest():
+        text.append('  {0:.2f}s {1}'.format(latency, host))
+    return text
+
+
+class Group(object):
+  """The hosts whose commands produced the same result."""
+
+  def __init__(self, mgmt_command):
+    """Constructor for Group.
+
+    Args:
+      mgmt_command : The first Command of the group, which represents it
+    """
+
+    self.command = mgmt_command
+    self.hosts = []
+
+  @property
+  def retcode(self):
+    return self.command.retcode
+
+  @property
+  def stdout(self):
+    return self.command.stdout
+
+  @property
+  def stderr(self):
+    return self.command.stderr
+
+  def status(self, color=True):
+    """This displays the hosts of the group and their shared result.
+
+    Args:
+      color : whether or not to color the output
+    """
+
+    color = _should_color(color)
+    hosts = '{0} ({1})'.format(_compact_hosts(self.hosts), len(self.hosts))
+    if color:
+      text = [colored(hosts, 'blue')]
+    else:
+      text = [hosts]
+    text.extend(self.command._result_lines(color, attempts=False))
+    return '\n'.join(text)
+
+
+class _Grouper(object):
+  """This groups commands by result as they complete.
+
+  Each result is reduced to a hash of its stdout, stderr and return code, so
+  only one Command is kept per distinct result.
+  """
+
+  def __init__(self):
+    self._groups = collections.OrderedDict()
+
+  def add(self, mgmt_command):
+    """Adds a completed command to the group of its result."""
+    if mgmt_command._out is None:
+      key = (mgmt_command.retcode, mgmt_command.timed_out)
+    else:
+      key = (mgmt_command.retcode, mgmt_command.timed_out,
+             mgmt_command._out.digest(), mgmt_command._err.digest())
+    group = self._groups.get(key)
+    if group is None:
+      group = self._groups[key] = Group(mgmt_command)
+    group.hosts.append(mgmt_command.host)
+
+  def groups(self):
+    """Returns the groups so far, in order of first appearance."""
+    return list(self._groups.values())
+
+
+class _HealthCache(object):
+  """This remembers which hosts were recently unreachable or slow.
+
+  Each host's latest result is kept in a JSON file, so that later operations
+  and other processes using the same file can start slow hosts first and
+  fail unreachable hosts fast. Entries older than 'ttl' seconds are ignored.
+  """
+
+  def __init__(self, path, ttl=HEALTH_TTL_DEFAULT):
+    """Constructor for _HealthCache.
+
+    Args:
+      path : The JSON file holding the entries, created if needed
+      ttl  : The seconds an entry is trusted after it was recorded
+    """
+
+    self.path = path
+    self.ttl = ttl
+    self._lock = threading.Lock()
+    self._hosts = self._load()
+
+  def _load(self):
+    """Returns the entries in the file, nothing if it is missing or bad."""
+    try:
+      with open(self.path) as fd:
+        hosts = json.load(fd)
+    except (IOError, OSError, ValueError):
+      return {}
+    if not isinstance(hosts, dict):
+      return {}
+    return hosts
+
+  def _fresh(self, entry, now):
+    return now - entry['time'] <= self.ttl
+
+  def entry(self, host):
+    """Returns the fresh entry of a host, None if there is none.
+
+    An entry is a dict of the wall-clock 'time' it was recorded, whether the
+    host was 'unreachable', and the seconds its command took as 'latency'.
+    """
+
+    entry = self._hosts.get(host)
+    if entry is None or not self._fresh(entry, time.time()):
+      return None
+    return entry
+
+  def unreachable(self, host):
+    """Returns whether a host recently couldn't be connected to."""
+    entry = self.entry(host)
+    return entry is not None and entry['unreachable']
+
+  def latency(self, host):
+    """Returns the recent latency of a host, 0 if it isn't known."""
+    entry = self.entry(host)
+    if entry is None:
+      return 0
+    return entry['latency']
+
+  def record(self, mgmt_command):
+    """Remembers the result of a command that ran on a host."""
+    if (mgmt_command.skipped or mgmt_command.cancelled or
+        mgmt_command.duration is None):
+      return
+    with self._lock:
+      self._hosts[mgmt_command.host] = {
+          'time': mgmt_command.end_time,
+          'unreachable': mgmt_command.unreachable,
+          'latency': mgmt_command.duration}
+
+  def save(self):
+    """Writes the entries, merged with those written by others meanwhile.
+
+    The newer entry of each host wins and stale entries are dropped. The
+    file is replaced atomically so readers never see a partial file.
+    """
+
+    with self._lock:
+      hosts = self._load()
+      for host, entry in self._hosts.items():
+        other = hosts.get(host)
+        if other is None or other['time'] < entry['time']:
+          hosts[host] = entry
+      now = time.time()
+      self._hosts = dict((host, entry) for host, entry in hosts.items()
+                         if self._fresh(entry, now))
+      directory = os.path.dirname(os.path.abspath(self.path))
+      if not os.path.isdir(directory):
+        os.makedirs(directory)
+      fd, tmp = tempfile.mkstemp(prefix='.paramgmt-health-', dir=directory)
+      try:
+        with os.fdopen(fd, 'w') as out:
+          json.dump(self._hosts, out, sort_keys=True)
+        os.rename(tmp, self.path)
+      except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class _Reporter(object):
+  """This displays the results of commands and tracks the failures."""
+
+  def __init__(self, quiet, color, group=False, output_format='text',
+               sink=None, slowest=SLOWEST_DEFAULT, progress=None,
+               rollout=None, health=None):
+    self._quiet = quiet
+    self._color = color
+    self.progress = progress
+    self.rollout = rollout
+    self.health = health
+    self.stats = Stats(slowest)
+    self._format = output_format
+    self._sink = sink
+    self.grouper = _Grouper() if group else None
+    self.total = 0
+    self.failed = []
+    self.timed_out = []
+    self.skipped = []
+    self.started_at = _now()
+
+  def add(self, mgmt_command):
+    """Reports a completed command."""
+    # a command created only once a slot freed up waited since the start
+    mgmt_command.queued_at = min(mgmt_command.queued_at, self.started_at)
+    self.total += 1
+    self.stats.add(mgmt_command)
+    if self.health is not None and mgmt_command.remote:
+      self.health.record(mgmt_command)
+    if self.grouper is not None:
+      self.grouper.add(mgmt_command)
+    if self._sink is not None:
+      self._sink(mgmt_command)
+    if self.progress is not None:
+      self.progress.reported(mgmt_command)
+    if self._quiet:
+      pass
+    elif self._format == 'jsonl':
+      self._print(json.dumps(mgmt_command.record(), sort_keys=True))
+    elif self.grouper is None:
+      self._print(mgmt_command.status(self._color))
+    if mgmt_command.skipped:
+      self.skipped.append(mgmt_command)
+    elif mgmt_command.timed_out:
+      self.timed_out.append(mgmt_command)
+    elif mgmt_command.retcode is not 0:
+      self.failed.append(mgmt_command)
+
+  def _print(self, text):
+    if self.progress is not None:
+      self.progress.print_above(text)
+    else:
+      print(text)
+      sys.stdout.flush()
+
+  def _show_hosts(self, title, mgmt_commands):
+    print(title)
+    if self.grouper is not None:
+      hosts = _compact_hosts(mgmt_command.host
+                             for mgmt_command in mgmt_commands)
+      if self._color:
+        hosts = colored(hosts, 'red')
+      print(hosts)
+      return
+    for mgmt_command in mgmt_commands:
+      host = mgmt_command.host
+      if self._color:
+        host = colored(host, 'red')
+      print(host)
+
+  def finish(self):
+    """Reports the summary once all commands have completed."""
+    if self.progress is not None:
+      self.progress.close()
+    if self.health is not None:
+      self.health.save()
+    if not self._quiet and self._format == 'text':
+      if self.grouper is not None:
+        for group in self.grouper.groups():
+          print(group.status(self._color))
+      for line in self.stats.summary():
+        print(line)
+      failures = len(self.failed)
+      timeouts = len(self.timed_out)
+      skips = len(self.skipped)
+      successes = self.total - failures - timeouts - skips
+      counts = ['{0} succeeded'.format(successes),
+                '{0} failed'.format(failures)]
+      if timeouts > 0:
+        counts.append('{0} timed out'.format(timeouts))
+      if skips > 0:
+        counts.append('{0} skipped'.format(skips))
+      counts.append('{0} total'.format(self.total))
+      print(', '.join(counts) + '\n')
+      if self.rollout is not None and self.rollout.aborted is not None:
+        aborted = 'Rollout aborted: {0}'.format(self.rollout.aborted)
+        if self._color:
+          aborted = colored(aborted, 'red')
+        print(aborted)
+      if failures > 0:
+        self._show_hosts('Failed hosts:', self.failed)
+      if timeouts > 0:
+        self._show_hosts('Timed out hosts:', self.timed_out)
+      if skips > 0:
+        self._show_hosts('Skipped hosts:', self.skipped)
+
+
+class Controller(object):
+  """This class offers parallel cluster management using SSH and SCP."""
+
+  def __init__(self, hosts, user=USER_DEFAULT, parallel=PARALLEL_DEFAULT,
+               quiet=QUIET_DEFAULT, color=COLOR_DEFAULT,
+               attempts=ATTEMPTS_DEFAULT, fanout=FANOUT_DEFAULT,
+               ordered=ORDERED_DEFAULT, group=GROUP_DEFAULT,
+               output_format=FORMAT_DEFAULT, sink=None,
+               slowest=SLOWEST_DEFAULT, progress=PROGRESS_DEFAULT,
+               canary=CANARY_DEFAULT, wave=WAVE_DEFAULT,
+               max_failures=MAX_FAILURES_DEFAULT,
+               max_failure_ratio=MAX_FAILURE_RATIO_DEFAULT,
+               cancel_on_abort=CANCEL_ON_ABORT_DEFAULT,
+               health_cache=None, health_ttl=HEALTH_TTL_DEFAULT,
+               dead_hosts=DEAD_HOSTS_DEFAULT,
+               ssh_program=SSH_PROGRAM_DEFAULT,
+               scp_program=SCP_PROGRAM_DEFAULT,
+               engine=ENGINE_DEFAULT,
+               multiplex=MULTIPLEX_DEFAULT, control_dir=None,
+               relay=RELAY_DEFAULT, relay_agent=RELAY_AGENT_DEFAULT,
+               capture_limit=CAPTURE_LIMIT_DEFAULT,
+               spill_dir=None, output_dir=None, timeout=TIMEOUT_DEFAULT,
+               backoff_base=BACKOFF_BASE_DEFAULT,
+               backoff_cap=BACKOFF_CAP_DEFAULT,
+               backoff_jitter=BACKOFF_JITTER_DEFAULT,
+               retry_limit=RETRY_LIMIT_DEFAULT,
+               connect_rate=CONNECT_RATE_DEFAULT,
+               script_cache=SCRIPT_CACHE_DEFAULT,
+               script_vars=SCRIPT_VARS_DEFAULT, sync=SYNC_DEFAULT,
+               tar=TAR_DEFAULT, tar_level=TAR_LEVEL_DEFAULT,
+               pull_streams=PULL_STREAMS_DEFAULT,
+               job_dir=JOB_DIR_DEFAULT):
+    """Constructor for Controller.
+
+    Args:
+      hosts    : A list of hostnames.
+      user     : The remote user account.
+      parallel : Run commands in parallel.
+      quiet    : Suppress printing output to stdout.
+      color    : Color the output. Only enabled if sys.stdout.isatty() is true
+                 and not quiet and termcolor was successfully imported.
+      attempts : Maximum number of process tries.
+      fanout   : Maximum number of hosts being worked on at once when running
+                 in parallel. Remaining hosts are queued and started as
+                 running ones complete.
+      ordered  : Report results in host order instead of completion order.
+                 A slow host then holds back the results of hosts after it.
+      group    : Group hosts with identical stdout, stderr and return code
+                 and print each distinct result once with its hosts, after
+                 all hosts have completed, instead of one status per host.
+                 The groups of the latest operation are in 'groups'.
+      output_format : How results are printed. 'text' prints each status
+                      and a summary. 'jsonl' prints one JSON object per
+                      host as it completes (see Command.record()) and no
+                      summary.
+      sink          : A function called with each Command as it completes,
+                      in the order results are reported, whether quiet or
+                      not.
+      slowest       : The number of slowest hosts listed in the summary and
+                      kept in 'stats'.
+      progress      : Show the number of hosts done, running and queued,
+                      the throughput and the ETA on stderr while operations
+                      run, also when quiet. On a terminal the line is
+                      redrawn in place, otherwise it is logged periodically.
+      canary            : The number of hosts run first, on their own,
+                          before any other host is started. 0 for none.
+      wave              : After the canary, hosts are started in waves of
+                          this many hosts, or of a percentage of the hosts
+                          given as a string like '10%'. Each wave starts
+                          once the previous one has completed. None starts
+                          all remaining hosts as fanout allows.
+      max_failures      : Abort once more than this many hosts have failed:
+                          queued hosts are not started and are reported as
+                          skipped. None for no limit.
+      max_failure_ratio : Abort once more than this fraction of the
+                          completed hosts have failed. It applies once
+                          enough hosts completed for one failure to stay
+                          within it, 20 hosts for 0.05. None for no limit.
+      cancel_on_abort   : Also kill the hosts running when aborting.
+      health_cache : A JSON file remembering, for 'health_ttl' seconds,
+                     which hosts were unreachable and how long each host
+                     took. It may be shared by many Controllers and runs.
+                     Hosts known to be slow are started first, and known
+                     unreachable hosts are handled as 'dead_hosts' says.
+                     None keeps no cache.
+      health_ttl   : The seconds a cached result is trusted.
+      dead_hosts   : What to do with hosts the cache knows as unreachable.
+                     'probe' makes a single connection attempt, 'skip'
+                     reports them as skipped without running anything, and
+                     'run' treats them like any other host.
+      ssh_program   : The ssh executable run on this machine.
+      scp_program   : The scp executable run on this machine. Relayed pushes
+                      still run 'scp' on the relaying hosts.
+      engine   : How child processes are managed. 'thread' runs each Command
+                 on its own thread. 'asyncio' runs them all on one event
+                 loop, which scales to many more hosts per process and
+                 enables the *_async methods.
+      multiplex   : Reuse one SSH connection per host across calls using
+                    OpenSSH ControlMaster. The first call to a host opens a
+                    persistent master connection that later ssh and scp
+                    processes ride on. Call close() (or use the Controller as
+                    a context manager) to shut the masters down.
+      control_dir : The directory holding the ControlMaster sockets. If not
+                    given, a private temporary directory is created and
+                    removed by close().
+      relay       : The branching factor of relayed pushes. If greater than
+                    zero, remote_push() sends the files to 'relay' hosts
+                    which then forward them to 'relay' more hosts each, and
+                    so on, instead of sending every copy from this machine.
+                    Each host then needs to be able to log into the others.
+      relay_agent : Whether relayed pushes forward this machine's SSH
+                    agent to the hosts that push to others, so that they
+                    can log in with its keys. Anyone with root on those
+                    hosts can use the agent while they push.
+      capture_limit : The number of bytes of each host's stdout and stderr
+                      held in memory, or None for no limit. Beyond it, only
+                      the head and tail are kept in memory and shown, and
+                      the complete stream is written to a spill file (see
+                      Command.stdout_path).
+      spill_dir     : The directory for spill files, which are kept. If
+                      None, temporary files are used and removed with their
+                      Command.
+      output_dir    : If given, each host's stdout and stderr are written
+                      straight to <output_dir>/<host>.out and .err as they
+                      arrive instead of being captured in memory, and status
+                      only shows the file names. With pull_streams, they
+                      hold the listing of each host's files, and the stderr
+                      of each file's transfer stays with its Command.
+      timeout       : The wall-clock seconds each host's command may take,
+                      including retries, or None for no limit. When it
+                      expires the process group is killed, the output so far
+                      is kept and the Command is marked timed_out. Each
+                      operation also accepts a per-call timeout.
+      backoff_base   : The seconds to wait before retrying after an SSH
+                       connection error. The wait doubles on each further
+                       retry.
+      backoff_cap    : The maximum seconds to wait before a retry.
+      backoff_jitter : The fraction of each wait that is randomized, from 0
+                       (none) to 1 (anywhere between zero and the full wait),
+                       so that hosts that failed together retry apart.
+      retry_limit    : The maximum number of retries running at once across
+                       all hosts of this Controller, or None for no limit.
+      connect_rate   : The maximum number of processes (and thus SSH
+                       connections) started per second, or None for no
+                       limit. Launches are spaced out evenly to stay below
+                       sshd's MaxStartups and spare authentication backends.
+      script_cache   : A remote directory in which remote_script() caches
+                       script bundles by content hash. Each bundle is read
+                       and hashed once per call, only sent to hosts that
+                       don't have it yet, and template variables are
+                       substituted on the remote side. None sends the
+                       scripts every time.
+      script_vars    : Whether all template variables are replaced in the
+                       text of scripts, instead of only '?HOST'. Variables
+                       like '?{name}' that a host has no value for are then
+                       left alone, as they may be the script's own text.
+      sync           : Use rsync instead of scp for remote_push() and
+                       remote_pull(), so only changed files and blocks are
+                       sent. Each Command then reports bytes_transferred and
+                       whether the host was already up_to_date.
+      tar            : If one of TAR_CODECS, remote_push() builds a single
+                       tar archive of the local files with that compression,
+                       once per call, and streams it to each host over one
+                       ssh connection to be unpacked into the destination
+                       directory. This beats scp and rsync for trees of many
+                       small files and takes precedence over sync.
+      tar_level      : The compression level of the tar archive.
+      pull_streams   : If given, remote_pull() transfers each remote file
+                       separately, with up to this many transfers running
+                       at once on each host, instead of one scp per host.
+                       Partially downloaded files are resumed from where
+                       they end, every file is checked against its remote
+                       SHA-256, and the local destination is a directory.
+                       This takes precedence over sync.
+      job_dir        : The remote directory holding a directory of the
+                       output and return code of each remote_job().
+    """
+
+    self._user = user
+    self._hosts = hosts
+    self._parallel = parallel
+    self._quiet = quiet
+    self._color = _should_color(color)
+    self._attempts = int(attempts)
+    self._fanout = int(fanout)
+    self._ordered = ordered
+    self._group = group
+    self.output_format = output_format
+    self._sink = sink
+    self._slowest = int(slowest)
+    self._progress = progress
+    self._progress_tracker = None
+    self._canary = int(canary)
+    self.wave = wave
+    self._max_failures = max_failures
+    self._max_failure_ratio = max_failure_ratio
+    self._cancel_on_abort = cancel_on_abort
+    self._rollout = None
+    self._health_cache = health_cache
+    self._health_ttl = float(health_ttl)
+    self._health = None
+    self.dead_hosts = dead_hosts
+    self._ssh_program = ssh_program
+    self._scp_program = scp_program
+    self._reporter = None
+    self.engine = engine
+    self._ssh_connect_timeout = 2
+    self._ssh_connection_attempts = 3
+    self._multiplex = multiplex
+    self._control_dir = control_dir
+    self._own_control_dir = False
+    self._control_persist = CONTROL_PERSIST_DEFAULT
+    self._mux_rspecs = set()
+    self._relay = int(relay)
+    self._relay_agent = relay_agent
+    self._capture_limit = capture_limit
+    self._spill_dir = spill_dir
+    self._output_dir = output_dir
+    self._timeout = timeout
+    self._retry_policy = _RetryPolicy(float(backoff_base), float(backoff_cap),
+                                      float(backoff_jitter), retry_limit)
+    self.connect_rate = connect_rate
+    self._script_cache = script_cache
+    self._script_vars = script_vars
+    self._sync = sync
+    self.tar = tar
+    self._tar_level = int(tar_level)
+    self.pull_streams = pull_streams
+    self._job_dir = job_dir
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    """Shuts down the SSH master connections opened by this Controller.
+
+    This is a no-op unless multiplexing was used. The Controller may still be
+    used afterwards, new master connections are then opened as needed.
+    """
+
+    if self._mux_rspecs:
+      mgmt_commands = []
+      for rspec in sorted(self._mux_rspecs):
+        command = [self._ssh_program, '-O', 'exit', '-o',
+                   'ControlPath={0}'.format(self._control_path()), rspec]
+        mgmt_commands.append(self._new_command(
+            rspec, command, 'close [{0}]'.format(rspec), attempts=1,
+            remote=False, output=False))
+      for _ in self._schedule(mgmt_commands):
+        pass
+      self._mux_rspecs.clear()
+    if self._own_control_dir:
+      shutil.rmtree(self._control_dir, ignore_errors=True)
+      self._control_dir = None
+      self._own_control_dir = False
+
+  @property
+  def user(self):
+    return self._user
+
+  @user.setter
+  def user(self, val):
+    self._user = val
+
+  @property
+  def parallel(self):
+    return self._parallel
+
+  @parallel.setter
+  def parallel(self, val):
+    self._parallel = val
+
+  @property
+  def quiet(self):
+    return self._quiet
+
+  @quiet.setter
+  def quiet(self, val):
+    self._quiet = val
+
+  @property
+  def color(self):
+    return self._color
+
+  @color.setter
+  def color(self, val, force=False):
+    if val and force:
+      if not CAN_COLOR:
+        raise EnvironmentError('package \'termcolor\' does not exist')
+      self._color = True
+    self._color = _should_color(val)
+
+  @property
+  def attempts(self):
+    return self._attempts
+
+  @attempts.setter
+  def attempts(self, val):
+    self._attempts = int(val)
+
+  @property
+  def fanout(self):
+    return self._fanout
+
+  @fanout.setter
+  def fanout(self, val):
+    self._fanout = int(val)
+
+  @property
+  def ordered(self):
+    return self._ordered
+
+  @ordered.setter
+  def ordered(self, val):
+    self._ordered = val
+
+  @property
+  def group(self):
+    return self._group
+
+  @group.setter
+  def group(self, val):
+    self._group = val
+
+  @property
+  def output_format(self):
+    return self._output_format
+
+  @output_format.setter
+  def output_format(self, val):
+    if val not in FORMATS:
+      raise ValueError('unknown output format: {0}'.format(val))
+    self._output_format = val
+
+  @property
+  def sink(self):
+    return self._sink
+
+  @sink.setter
+  def sink(self, val):
+    self._sink = val
+
+  @property
+  def slowest(self):
+    return self._slowest
+
+  @slowest.setter
+  def slowest(self, val):
+    self._slowest = int(val)
+
+  @property
+  def progress(self):
+    return self._progress
+
+  @progress.setter
+  def progress(self, val):
+    self._progress = val
+
+  @property
+  def canary(self):
+    return self._canary
+
+  @canary.setter
+  def canary(self, val):
+    self._canary = int(val)
+
+  @property
+  def wave(self):
+    return self._wave
+
+  @wave.setter
+  def wave(self, val):
+    if val is not None:
+      _wave_size(val, 100)
+    self._wave = val
+
+  @property
+  def max_failures(self):
+    return self._max_failures
+
+  @max_failures.setter
+  def max_failures(self, val):
+    self._max_failures = val
+
+  @property
+  def max_failure_ratio(self):
+    return self._max_failure_ratio
+
+  @max_failure_ratio.setter
+  def max_failure_ratio(self, val):
+    self._max_failure_ratio = val
+
+  @property
+  def cancel_on_abort(self):
+    return self._cancel_on_abort
+
+  @cancel_on_abort.setter
+  def cancel_on_abort(self, val):
+    self._cancel_on_abort = val
+
+  @property
+  def health_cache(self):
+    return self._health_cache
+
+  @health_cache.setter
+  def health_cache(self, val):
+    self._health_cache = val
+    self._health = None
+
+  @property
+  def health_ttl(self):
+    return self._health_ttl
+
+  @health_ttl.setter
+  def health_ttl(self, val):
+    self._health_ttl = float(val)
+    self._health = None
+
+  @property
+  def dead_hosts(self):
+    return self._dead_hosts
+
+  @dead_hosts.setter
+  def dead_hosts(self, val):
+    if val not in DEAD_HOSTS_POLICIES:
+      raise ValueError('unknown dead_hosts policy: {0}'.format(val))
+    self._dead_hosts = val
+
+  @property
+  def ssh_program(self):
+    return self._ssh_program
+
+  @ssh_program.setter
+  def ssh_program(self, val):
+    self._ssh_program = val
+
+  @property
+  def scp_program(self):
+    return self._scp_program
+
+  @scp_program.setter
+  def scp_program(self, val):
+    self._scp_program = val
+
+  @property
+  def stats(self):
+    """The Stats of the latest operation so far, None before any."""
+    if self._reporter is None:
+      return None
+    return self._reporter.stats
+
+  @property
+  def groups(self):
+    """The Groups of the latest operation so far, None if not grouping."""
+    if self._reporter is None or self._reporter.grouper is None:
+      return None
+    return self._reporter.grouper.groups()
+
+  @property
+  def engine(self):
+    return self._engine
+
+  @engine.setter
+  def engine(self, val):
+    if val not in ENGINES:
+      raise ValueError('unknown engine: {0}'.format(val))
+    if val == 'asyncio':
+      _load_aio()
+    self._engine = val
+
+  @property
+  def multiplex(self):
+    return self._multiplex
+
+  @multiplex.setter
+  def multiplex(self, val):
+    self._multiplex = val
+
+  @property
+  def control_dir(self):
+    return self._control_dir
+
+  @property
+  def control_persist(self):
+    return self._control_persist
+
+  @control_persist.setter
+  def control_persist(self, val):
+    self._control_persist = int(val)
+
+  @property
+  def relay(self):
+    return self._relay
+
+  @relay.setter
+  def relay(self, val):
+    self._relay = int(val)
+
+  @property
+  def relay_agent(self):
+    return self._relay_agent
+
+  @relay_agent.setter
+  def relay_agent(self, val):
+    self._relay_agent = val
+
+  @property
+  def capture_limit(self):
+    return self._capture_limit
+
+  @capture_limit.setter
+  def capture_limit(self, val):
+    self._capture_limit = val
+
+  @property
+  def spill_dir(self):
+    return self._spill_dir
+
+  @spill_dir.setter
+  def spill_dir(self, val):
+    self._spill_dir = val
+
+  @property
+  def output_dir(self):
+    return self._output_dir
+
+  @output_dir.setter
+  def output_dir(self, val):
+    self._output_dir = val
+
+  @property
+  def timeout(self):
+    return self._timeout
+
+  @timeout.setter
+  def timeout(self, val):
+    self._timeout = val
+
+  @property
+  def backoff_base(self):
+    return self._retry_policy.base
+
+  @backoff_base.setter
+  def backoff_base(self, val):
+    self._retry_policy.base = float(val)
+
+  @property
+  def backoff_cap(self):
+    return self._retry_policy.cap
+
+  @backoff_cap.setter
+  def backoff_cap(self, val):
+    self._retry_policy.cap = float(val)
+
+  @property
+  def backoff_jitter(self):
+    return self._retry_policy.jitter
+
+  @backoff_jitter.setter
+  def backoff_jitter(self, val):
+    self._retry_policy.jitter = float(val)
+
+  @property
+  def retry_limit(self):
+    return self._retry_policy.limit
+
+  @retry_limit.setter
+  def retry_limit(self, val):
+    self._retry_policy.limit = val
+
+  @property
+  def connect_rate(self):
+    if self._launch_bucket is None:
+      return None
+    return self._launch_bucket.rate
+
+  @connect_rate.setter
+  def connect_rate(self, val):
+    if val is None:
+      self._launch_bucket = None
+    else:
+      self._launch_bucket = _TokenBucket(val)
+
+  @property
+  def script_cache(self):
+    return self._script_cache
+
+  @script_cache.setter
+  def script_cache(self, val):
+    self._script_cache = val
+
+  @property
+  def script_vars(self):
+    return self._script_vars
+
+  @script_vars.setter
+  def script_vars(self, val):
+    self._script_vars = val
+
+  @property
+  def sync(self):
+    return self._sync
+
+  @sync.setter
+  def sync(self, val):
+    self._sync = val
+
+  @property
+  def tar(self):
+    return self._tar
+
+  @tar.setter
+  def tar(self, val):
+    if val is not None and val not in TAR_CODECS:
+      raise ValueError('unknown tar codec: {0}'.format(val))
+    self._tar = val
+
+  @property
+  def tar_level(self):
+    return self._tar_level
+
+  @tar_level.setter
+  def tar_level(self, val):
+    self._tar_level = int(val)
+
+  @property
+  def pull_streams(self):
+    return self._pull_streams
+
+  @pull_streams.setter
+  def pull_streams(self, val):
+    if val is not None:
+      val = int(val)
+      if val < 1:
+        raise ValueError('pull_streams must be greater than 0')
+    self._pull_streams = val
+
+  @property
+  def job_dir(self):
+    return self._job_dir
+
+  @job_dir.setter
+  def job_dir(self, val):
+    self._job_dir = val
+
+  @property
+  def ssh_connect_timeout(self):
+    return self._ssh_connect_timeout
+
+  @ssh_connect_timeout.setter
+  def ssh_connect_timeout(self, val):
+    self._ssh_connect_timeout = int(val)
+
+  @property
+  def ssh_connection_attempts(self):
+    return self._ssh_connection_attempts
+
+  @ssh_connection_attempts.setter
+  def ssh_connection_attempts(self, val):
+    self._ssh_connection_attempts = int(val)
+
+  def _control_path(self):
+    """Returns the ControlPath, creating the socket directory if needed."""
+    if self._control_dir is None:
+      self._control_dir = tempfile.mkdtemp(prefix='paramgmt-')
+      self._own_control_dir = True
+    # %C is a short hash of the connection, keeping socket paths short
+    return os.path.join(self._control_dir, '%C')
+
+  def _ssh_options(self, multiplex=True):
+    options = ['-o', 'PasswordAuthentication=no',
+               '-o', 'ConnectTimeout={0}'
+               .format(self._ssh_connect_timeout),
+               '-o', 'ConnectionAttempts={0}'
+               .format(self._ssh_connection_attempts)]
+    if self._multiplex and multiplex:
+      options.extend(['-o', 'ControlMaster=auto',
+                      '-o', 'ControlPath={0}'.format(self._control_path()),
+                      '-o', 'ControlPersist={0}'
+                      .format(self._control_persist)])
+    return options
+
+  def _copy_command(self):
+    """Returns the start of a push or pull command, before the paths."""
+    if self._sync:
+      shell = ' '.join(quote(arg) for arg in
+                       [self._ssh_program] + self._ssh_options())
+      return ['rsync', '-az', '--partial', '--stats', '-e', shell]
+    command = [self._scp_program, '-r']
+    command.extend(self._ssh_options())
+    return command
+
+  def _rspec(self, host):
+    """Returns the SSH destination for a host."""
+    if self._user:
+      rspec = '{0}@{1}'.format(self._user, host)
+    else:
+      rspec = '{0}'.format(host)
+    if self._multiplex:
+      self._mux_rspecs.add(rspec)
+    return rspec
+
+  def _host_values(self):
+    """Yields the values of the template variables of each host."""
+    user = self._user
+    if not user:
+      try:
+        user = getpass.getuser()
+      except (KeyError, OSError):
+        user = ''
+    variables = getattr(self._hosts, 'variables', None)
+    for idx, host in enumerate(self._hosts):
+      values = {}
+      if variables is not None:
+        values.update(variables(host))
+      values['HOST'] = host
+      values['USER'] = user
+      values['INDEX'] = str(idx)
+      yield values
+
+  def _fanout_limit(self):
+    """Returns the number of commands that may run at once."""
+    if self._parallel:
+      return max(1, self._fanout)
+    return 1
+
+  def _health_tracker(self):
+    """Returns the _HealthCache, loading it on first use, or None."""
+    if self._health_cache is None:
+      return None
+    if self._health is None:
+      self._health = _HealthCache(self._health_cache, self._health_ttl)
+    return self._health
+
+  def _health_priority(self):
+    """Returns the start order of commands by host latency, or None."""
+    health = self._health_tracker()
+    if health is None:
+      return None
+    return lambda mgmt_command: -health.latency(mgmt_command.host)
+
+  def _new_command(self, host, commands, description, stdin=None,
+                   attempts=None, remote=True, output=True):
+    """Creates a Command for the selected engine.
+
+    Args:
+      remote : Whether the command connects to the host, so that its result
+               tells whether the host is reachable
+      output : Whether the command's output is written to output_dir, which
+               only holds the output of one command per host
+    """
+    if attempts is None:
+      attempts = self._attempts
+    output_dir = self._output_dir if output else None
+    if output_dir is not None and not os.path.isdir(output_dir):
+      os.makedirs(output_dir)
+    if self._engine == 'asyncio':
+      command_class = _load_aio().AsyncCommand
+    else:
+      command_class = Command
+    mgmt_command = command_class(host, commands, attempts, description, stdin,
+                                 self._capture_limit, self._spill_dir,
+                                 output_dir, self._timeout,
+                                 self._retry_policy, self._launch_bucket)
+    mgmt_command.cancellable = self._cancel_on_abort
+    mgmt_command.remote = remote
+    health = self._health_tracker()
+    if (remote and health is not None and self._dead_hosts != 'run' and
+        health.unreachable(host)):
+      if self._dead_hosts == 'skip':
+        mgmt_command.skip(_SKIP_DEAD)
+      else:
+        # one cheap attempt that fails as fast as ssh can
+        mgmt_command.max_attempts = 1
+        mgmt_command.commands = [
+            re.sub(r'ConnectionAttempts=\d+', 'ConnectionAttempts=1', arg)
+            for arg in commands]
+    return mgmt_command
+
+  def _timed(self, mgmt_commands, timeout):
+    """This applies the timeout of one call to its Commands."""
+    for mgmt_command in mgmt_commands:
+      if timeout is not None:
+        mgmt_command.timeout = timeout
+      yield mgmt_command
+
+  def _require_asyncio(self):
+    if self._engine != 'asyncio':
+      raise EnvironmentError('*_async methods require the asyncio engine')
+
+  def _schedule(self, mgmt_commands, per_host=None):
+    """This runs the specified commands through a bounded set of workers.
+
+    At most 'fanout' commands (one if not parallel) are running at any time.
+    The remaining commands wait in a queue and are started as running ones
+    complete, so thread and file descriptor usage does not grow with the
+    number of hosts.
+
+    Args:
+      mgmt_commands  : An iterable of Commands
+      per_host       : The maximum number of commands running at once on
+                       each host, or None for no limit
+
+    Yields:
+      Each Command as it completes, in completion order
+    """
+
+    if self._engine == 'asyncio':
+      for mgmt_command in self._schedule_asyncio(mgmt_commands, per_host):
+        yield mgmt_command
+      return
+
+    fanout = self._fanout_limit()
+    done = queue.Queue()
+    slots = _HostSlots(mgmt_commands, per_host, self._progress_tracker,
+                       self._rollout, self._health_priority())
+    running = 0
+    while True:
+      # fill all free slots
+      while running < fanout:
+        mgmt_command = slots.take()
+        if mgmt_command is None:
+          break
+        mgmt_command.done_queue = done
+        mgmt_command.start()
+        running += 1
+      if running == 0:
+        for mgmt_command in slots.remaining():
+          yield mgmt_command
+        return
+
+      # wait for any command to finish
+      mgmt_command = done.get()
+      mgmt_command.join()
+      running -= 1
+      slots.release(mgmt_command)
+      yield mgmt_command
+
+  def _schedule_asyncio(self, mgmt_commands, per_host=None):
+    """This runs the specified commands on an event loop in another thread.
+
+    Args:
+      mgmt_commands  : An iterable of AsyncCommands
+      per_host       : The maximum number of commands running at once on
+                       each host, or None for no limit
+
+    Yields:
+      Each AsyncCommand as it completes, in completion order
+    """
+
+    done = queue.Queue()
+    loop_thread = threading.Thread(
+        target=_load_aio().run_to_queue,
+        args=(mgmt_commands, self._fanout_limit(), done, per_host,
+              self._progress_tracker, self._rollout,
+              self._health_priority()))
+    loop_thread.daemon = True
+    loop_thread.start()
+    while True:
+      item = done.get()
+      if item is None:
+        break
+      if isinstance(item, BaseException):
+        loop_thread.join()
+        raise item
+      yield item
+    loop_thread.join()
+
+  def _iter_commands(self, mgmt_commands):
+    """This runs the specified commands and reports on them as they complete.
+
+    Unless quiet, each Command's status is printed as it is yielded and a
+    summary is printed once all Commands have completed.
+
+    Args:
+      mgmt_commands  : An iterable of Commands
+
+    Yields:
+      Each Command as it completes (in the given order if ordered)
+    """
+
+    return self._report_iter(self._schedule(mgmt_commands),
+                             self._host_count())
+
+  def _new_reporter(self, total=None):
+    """Creates the _Reporter of an operation, remembering it for groups.
+
+    Args:
+      total : The number of results expected, for the progress display
+    """
+
+    if self._progress:
+      self._progress_tracker = _Progress(total)
+    else:
+      self._progress_tracker = None
+    if (self._canary or self._wave is not None or
+        self._max_failures is not None or
+        self._max_failure_ratio is not None):
+      self._rollout = _Rollout(self._host_count(), self._canary, self._wave,
+                               self._max_failures, self._max_failure_ratio,
+                               self._cancel_on_abort)
+    else:
+      self._rollout = None
+    self._reporter = _Reporter(self._quiet, self._color, self._group,
+                               self._output_format, self._sink,
+                               self._slowest, self._progress_tracker,
+                               self._rollout, self._health_tracker())
+    return self._reporter
+
+  def _host_count(self):
+    """Returns the number of hosts, None if they are not counted up front."""
+    try:
+      return len(self._hosts)
+    except TypeError:
+      return None
+
+  def _report_iter(self, completed, total=None):
+    """This reports on commands as they complete.
+
+    Args:
+      completed : An iterable of completed Commands, each with its index set
+                  to its position among all Commands of the operation
+      total     : The number of Commands in 'completed' if known
+
+    Yields:
+      Each Command after it is reported (in index order if ordered)
+    """
+
+    reporter = self._new_reporter(total)
+    sequencer = _Sequencer() if self._ordered else None
+    try:
+      for mgmt_command in completed:
+        if sequencer is not None:
+          ready = sequencer.add(mgmt_command)
+        else:
+          ready = [mgmt_command]
+        for mgmt_command in ready:
+          reporter.add(mgmt_command)
+          yield mgmt_command
+      reporter.finish()
+    finally:
+      # the caller may stop iterating early
+      if reporter.progress is not None:
+        reporter.progress.close()
+      self._progress_tracker = None
+      self._rollout = None
+
+  def _run_commands(self, mgmt_commands):
+    """This runs the specified commands.
+
+    Args:
+      mgmt_commands  : A list of Commands
+
+    Returns:
+      Nothing, but it completes mgmt_command objects
+    """
+
+    for _ in self._iter_commands(mgmt_commands):
+      pass
+
+  def _run_commands_async(self, mgmt_commands):
+    """This runs the specified commands on the running event loop.
+
+    Args:
+      mgmt_commands  : A list of AsyncCommands
+
+    Returns:
+      A coroutine that completes the AsyncCommands and returns them
+    """
+
+    return _load_aio().run_commands(
+        mgmt_commands, self._fanout_limit(),
+        self._new_reporter(len(mgmt_commands)),
+        _Sequencer() if self._ordered else None, self._health_priority())
+
+  def probe(self, port=PROBE_PORT_DEFAULT, timeout=PROBE_TIMEOUT_DEFAULT,
+            fanout=PROBE_FANOUT_DEFAULT):
+    """Checks which hosts accept a TCP connection, without running ssh.
+
+    All hosts are probed from one event loop, with up to 'fanout'
+    connections in flight, and nothing is printed. This requires Python
+    3.8+, but not the asyncio engine.
+
+    Args:
+      port    : The port connected to
+      timeout : The seconds each host has to resolve and accept
+      fanout  : The maximum number of connections in flight. It is lowered
+                to leave file descriptors for the rest of the process.
+
+    Returns:
+      A ProbeResult whose 'live' and 'dead' lists of hosts can be given to
+      Controllers of later operations.
+    """
+
+    return _load_aio().probe_hosts(list(self._hosts), port, timeout, fanout)
+
+  def probe_async(self, port=PROBE_PORT_DEFAULT,
+                  timeout=PROBE_TIMEOUT_DEFAULT, fanout=PROBE_FANOUT_DEFAULT):
+    """Like probe(), but returns a coroutine to be awaited.
+
+    Returns:
+      A coroutine returning a ProbeResult.
+    """
+
+    return _load_aio().probe(list(self._hosts), port, timeout, fanout)
+
+  def local_command(self, commands, timeout=None):
+    """Run local command for all hosts specified.
+
+    Args:
+      commands : The local commands.
+                 Template variables like '?HOST' are replaced.
+      timeout  : Overrides the Controller's timeout for this call.
+
+    Returns:
+      A list of Command objects.
+    """
+
+    mgmt_commands = list(self._timed(
+        self._local_command_commands(commands), timeout))
+    self._run_commands(mgmt_commands)
+    return mgmt_commands
+
+  def local_command_iter(self, commands, timeout=None):
+    """Like local_command(), but yields each Command as it completes.
+
+    Args:
+      commands : The local commands.
+                 Template variables like '?HOST' are replaced.
+      timeout  : Overrides the Controller's timeout for this call.
+
+    Returns:
+      An iterator of Command objects in completion order (host order if
+      the Controller is ordered).
+    """
+
+    return self._iter_commands(self._timed(
+        self._local_command_commands(commands), timeout))
+
+  def local_command_async(self, commands, timeout=None):
+    """Like local_command(), but returns a coroutine to be awaited.
+
+    This requires the asyncio engine.
+
+    Returns:
+      A coroutine returning a list of AsyncCommand objects.
+    """
+
+    self._require_asyncio()
+    return self._run_commands_async(
+        list(self._timed(self._local_command_commands(commands), timeout)))
+
+  def _local_command_commands(self, commands):
+    """This generates the Commands for local_command()."""
+
+    templates = _templates(commands)
+    for values in self._host_values():
+      host = values['HOST']
+      command = ' '.join(template.render(values) for template in templates)
+      mgmt_command = self._new_command(
+          host, ['/bin/sh'], 'lcmd [{0}]: {1}'.format(host, command),
+          command, remote=False)
+      yield mgmt_command
+
+  def remote_command(self, commands, timeout=None):
+    """Run SSH command to all hosts specified.
+
+    Args:
+      commands : The remote commands of the SSH command.
+                 Template variables like '?HOST' are replaced.
+      timeout  : Overrides the Controller's timeout for this call.
+
+    Returns:
+      A list of Command objects.
+    """
+
+    mgmt_commands = list(self._timed(
+        self._remote_command_commands(commands), timeout))
+    self._run_commands(mgmt_commands)
+    return mgmt_commands
+
+  def remote_command_iter(self, commands, timeout=None):
+    """Like remote_command(), but yields each Command as it completes.
+
+    Args:
+      commands : The remote commands of the SSH command.
+                 Template variables like '?HOST' are replaced.
+      timeout  : Overrides the Controller's timeout for this call.
+
+    Returns:
+      An iterator of Command objects in completion order (host order if
+      the Controller is ordered).
+    """
+
+    return self._iter_commands(self._timed(
+        self._remote_command_commands(commands), timeout))
+
+  def remote_command_async(self, commands, timeout=None):
+    """Like remote_command(), but returns a coroutine to be awaited.
+
+    This requires the asyncio engine.
+
+    Returns:
+      A coroutine returning a list of AsyncCommand objects.
+    """
+
+    self._require_asyncio()
+    return self._run_commands_async(
+        list(self._timed(self._remote_command_commands(commands), timeout)))
+
+  def _remote_command_commands(self, commands):
+    """This generates the Commands for remote_command()."""
+
+    templates = _templates(commands)
+    options = self._ssh_options()
+    for values in self._host_values():
+      host = values['HOST']
+      rspec = self._rspec(host)
+      args = [template.render(values) for template in templates]
+      command = [self._ssh_program]
+      command.extend(options)
+      command.append(rspec)
+      command.extend(args)
+      desc = ' '.join(['rcmd [{0}]:'.format(rspec)] + args)
+      mgmt_command = self._new_command(host, command, desc)
+      yield mgmt_command
+
+  def remote_push(self, local, remote, timeout=None):
+    """Push specified documents to all remote hosts via SCP.
+
+    Args:
+      local     : A list of local file(s) and/or directory(ies)
+                  Template variables like '?HOST' are replaced.
+      remote    : A string specification of the remote destination file(s).
+                  Template variables like '?HOST' are replaced.
+                  When relaying, this must be an existing directory.
+      timeout   : Overrides the Controller's timeout for this call.
+
+    Returns:
+      A list of Command objects. When relaying, the 'source' of each Command
+      is the host it was pushed from, or None if pushed from this machine.
+    """
+
+    if self._relay:
+      mgmt_commands = list(self._iter_relay(local, remote, timeout))
+      mgmt_commands.sort(key=lambda mgmt_command: mgmt_command.index)
+      return mgmt_commands
+
+    mgmt_commands = list(self._timed(
+        self._remote_push_commands(local, remote), timeout))
+    self._run_commands(mgmt_commands)
+    return mgmt_commands
+
+  def remote_push_iter(self, local, remote, timeout=None):
+    """Like remote_push(), but yields each Command as it completes.
+
+    Args:
+      local     : A list of local file(s) and/or directory(ies)
+                  Template variables like '?HOST' are replaced.
+      remote    : A string specification of the remote destination file(s).
+                  Template variables like '?HOST' are replaced.
+      timeout   : Overrides the Controller's timeout for this call.
+
+    Returns:
+      An iterator of Command objects in completion order (host order if
+      the Controller is ordered).
+    """
+
+    if self._relay:
+      return self._iter_relay(local, remote, timeout)
+    return self._iter_commands(self._timed(
+        self._remote_push_commands(local, remote), timeout))
+
+  def remote_push_async(self, local, remote, timeout=None):
+    """Like remote_push(), but returns a coroutine to be awaited.
+
+    This requires the asyncio engine.
+
+    Returns:
+      A coroutine returning a list of AsyncCommand objects.
+    """
+
+    self._require_asyncio()
+    if self._relay:
+      raise EnvironmentError('remote_push_async does not support relaying')
+    return self._run_commands_async(
+        list(self._timed(self._remote_push_commands(local, remote), timeout)))
+
+  def _remote_push_commands(self, local, remote):
+    """This generates the Commands for remote_push()."""
+
+    archive = self._push_archive(local)
+    local = _templates(local)
+    remote = _Template(remote)
+    for values in self._host_values():
+      yield self._push_command(values, local, remote, archive)
+
+  def _push_archive(self, local):
+    """This builds the archive for a tar push, or returns None."""
+    if self._tar is None:
+      return None
+    for template in _templates(local):
+      if template.names:
+        raise ValueError('tar push requires the same files for all hosts')
+    return _Archive(local, self._tar, self._tar_level)
+
+  def _push_command(self, values, local, remote, archive=None):
+    """This creates the Command pushing from this machine to one host.
+
+    Args:
+      values  : The template values of the host
+      local   : The _Templates of the local files
+      remote  : The _Template of the remote destination
+      archive : The _Archive streamed by a tar push, or None
+    """
+
+    if archive is not None:
+      return self._tar_push_command(values, local, remote, archive)
+    host = values['HOST']
+    rspec = self._rspec(host)
+    sources = [template.render(values) for template in local]
+    dest = '{0}:{1}'.format(rspec, remote.render(values))
+    command = self._copy_command()
+    command.extend(sources)
+    command.append(dest)
+    desc = 'rpush [{0}]: {1} => {2}'.format(rspec, ' '.join(sources), dest)
+    mgmt_command = self._new_command(host, command, desc)
+    if self._sync:
+      mgmt_command.sync_stat = 'Total bytes sent'
+    return mgmt_command
+
+  def _tar_push_command(self, values, local, remote, archive):
+    """This creates the Command streaming a tar archive to one host."""
+
+    host = values['HOST']
+    remote = remote.render(values)
+    command = [self._ssh_program, '-T']
+    command.extend(self._ssh_options())
+    rspec = self._rspec(host)
+    command.append(rspec)
+    command.append('mkdir -p {0} && tar -x{1}f - -C {0}'.format(
+        _quote_path(remote), _TAR_FLAGS[archive.codec]))
+    desc = 'rpush [{0}]: {1} => {0}:{2} (tar stream, {3})'.format(
+        rspec, ' '.join(template.text for template in local), remote,
+        archive.codec)
+    return self._new_command(host, command, desc, archive)
+
+  def _relay_command(self, source, values, local, remote):
+    """This creates the Command that has 'source' push to a host.
+
+    The source runs scp itself, so it must be able to authenticate to the
+    destination, with the forwarded SSH agent if relay_agent is set.
+
+    Args:
+      source : The template values of the source host
+      values : The template values of the destination host
+      local  : The _Templates of the local files
+      remote : The _Template of the remote destination
+    """
+
+    host = values['HOST']
+    source_dir = remote.render(source)
+    source = source['HOST']
+    sources = []
+    for template in local:
+      name = os.path.basename(template.text.rstrip('/'))
+      sources.append(_quote_path(posixpath.join(source_dir, name)))
+    rspec = self._rspec(host)
+    dest = '{0}:{1}'.format(rspec, remote.render(values))
+    relay = ['scp', '-r']
+    relay.extend(quote(o) for o in self._ssh_options(multiplex=False))
+    relay.extend(sources)
+    relay.append(quote(dest))
+
+    command = [self._ssh_program]
+    if self._relay_agent:
+      # a shared master connection may have been opened without the agent
+      command.extend(['-A', '-o', 'ControlPath=none'])
+      command.extend(self._ssh_options(multiplex=False))
+    else:
+      command.extend(self._ssh_options())
+    command.append(self._rspec(source))
+    command.append(' '.join(relay))
+    desc = 'rpush [{0}] (via {1}): {2} => {3}'.format(
+        rspec, source, ' '.join(template.text for template in local), dest)
+    mgmt_command = self._new_command(host, command, desc)
+    mgmt_command.source = source
+    return mgmt_command
+
+  def _iter_relay(self, local, remote, timeout):
+    """This pushes to all hosts as a tree, reporting results as they complete.
+
+    The push happens in rounds. In each round this machine and every host
+    that already holds the files each push to up to 'relay' new hosts, so the
+    number of holders grows geometrically and the number of rounds grows
+    with the log of the number of hosts. A host whose relayed push fails is
+    retried from this machine in the next round.
+
+    Args:
+      local     : A list of local file(s) and/or directory(ies)
+      remote    : The remote destination directory
+      timeout   : The per-call timeout, or None
+
+    Returns:
+      An iterator of the final Command of each host as it completes
+    """
+
+    for template in _templates(local):
+      if template.names:
+        raise ValueError('relay push requires the same files for all hosts')
+    return self._report_iter(self._relay_rounds(local, remote, timeout),
+                             self._host_count())
+
+  def _relay_rounds(self, local, remote, timeout):
+    """This runs the rounds of a relayed push, see _iter_relay()."""
+
+    archive = self._push_archive(local)
+    local = _templates(local)
+    remote = _Template(remote)
+    pending = collections.deque(self._host_values())
+    retry = collections.deque()
+    holders = []
+    position = {}
+    while pending or retry:
+      # create this round's pushes, this machine serves retries first
+      round_commands = []
+      for _ in range(self._relay):
+        if not retry and not pending:
+          break
+        values = (retry or pending).popleft()
+        mgmt_command = self._push_command(values, local, remote, archive)
+        position[id(mgmt_command)] = values
+        round_commands.append(mgmt_command)
+      for source in holders:
+        for _ in range(self._relay):
+          if not pending:
+            break
+          values = pending.popleft()
+          mgmt_command = self._relay_command(source, values, local, remote)
+          position[id(mgmt_command)] = values
+          round_commands.append(mgmt_command)
+
+      # run the round
+      round_commands = list(self._timed(round_commands, timeout))
+      for mgmt_command in self._schedule(round_commands):
+        values = position.pop(id(mgmt_command))
+        if mgmt_command.retcode == 0:
+          holders.append(values)
+        elif mgmt_command.source is not None:
+          retry.append(values)
+          continue
+        mgmt_command.index = int(values['INDEX'])
+        yield mgmt_command
+
+  def remote_pull(self, remote, local, timeout=None):
+    """Push specified documents to all remote hosts via SCP.
+
+    Args:
+      remote    : A list of remote file(s) and/or directory(ies)
+                  Template variables like '?HOST' are replaced.
+      local     : A string specification of the local destination file(s).
+                  Template variables like '?HOST' are replaced.
+      timeout   : Overrides the Controller's timeout for this call.
+
+    Returns:
+      A list of Command objects. With pull_streams, there is one Command per
+      pulled file, plus the listing Command of each host that failed or had
+      no files.
+    """
+
+    if self._pull_streams is not None:
+      mgmt_commands = list(self._iter_streamed_pull(remote, local, timeout))
+      mgmt_commands.sort(key=lambda mgmt_command: mgmt_command.index)
+      return mgmt_commands
+
+    mgmt_commands = list(self._timed(
+        self._remote_pull_commands(remote, local), timeout))
+    self._run_commands(mgmt_commands)
+    return mgmt_commands
+
+  def remote_pull_iter(self, remote, local, timeout=None):
+    """Like remote_pull(), but yields each Command as it completes.
+
+    Args:
+      remote    : A list of remote file(s) and/or directory(ies)
+                  Template variables like '?HOST' are replaced.
+      local     : A string specification of the local destination file(s).
+                  Template variables like '?HOST' are replaced.
+      timeout   : Overrides the Controller's timeout for this call.
+
+    Returns:
+      An iterator of Command objects in completion order (host order if
+      the Controller is ordered).
+    """
+
+    if self._pull_streams is not None:
+      return self._iter_streamed_pull(remote, local, timeout)
+    return self._iter_commands(self._timed(
+        self._remote_pull_commands(remote, local), timeout))
+
+  def remote_pull_async(self, remote, local, timeout=None):
+    """Like remote_pull(), but returns a coroutine to be awaited.
+
+    This requires the asyncio engine.
+
+    Returns:
+      A coroutine returning a list of AsyncCommand objects.
+    """
+
+    self._require_asyncio()
+    if self._pull_streams is not None:
+      raise EnvironmentError('remote_pull_async does not support streams')
+    return self._run_commands_async(
+        list(self._timed(self._remote_pull_commands(remote, local), timeout)))
+
+  def _remote_pull_commands(self, remote, local):
+    """This generates the Commands for remote_pull()."""
+
+    remote = _templates(remote)
+    local = _Template(local)
+    for values in self._host_values():
+      host = values['HOST']
+      command = self._copy_command()
+      rspec = self._rspec(host)
+      paths = [template.render(values) for template in remote]
+      if self._sync:
+        # rsync takes each remote source as a separate argument
+        sources = ['{0}:{1}'.format(rspec, path) for path in paths]
+        command.extend(sources)
+        source = ' '.join(sources)
+      else:
+        source = ','.join(paths)
+        if len(paths) > 1:
+          source = '{{{0}}}'.format(source)
+        source = '{0}:{1}'.format(rspec, source)
+        command.append(source)
+      dest = local.render(values)
+      command.append(dest)
+      desc = 'rpull [{0}]: {1} => {2}'.format(rspec, source, dest)
+      mgmt_command = self._new_command(host, command, desc)
+      if self._sync:
+        mgmt_command.sync_stat = 'Total bytes received'
+      yield mgmt_command
+
+  def _iter_streamed_pull(self, remote, local, timeout):
+    """This pulls each remote file separately, see pull_streams.
+
+    First every host lists its files with their sizes and SHA-256. The files
+    are then pulled with 'tail -c +N', each host's largest files first and
+    up to 'pull_streams' at once per host. A local file that is shorter
+    than its remote file is taken to be an interrupted pull and only the
+    rest is transferred. A file that fails its checksum is removed so that
+    the next pull starts it over.
+
+    Args:
+      remote    : A list of remote file(s) and/or directory(ies)
+      local     : The local destination directory
+      timeout   : The per-call timeout, or None
+
+    Returns:
+      An iterator of the Command of each file as it completes
+    """
+
+    return self._report_iter(self._streamed_pull_phases(remote, local,
+                                                         timeout))
+
+  def _streamed_pull_phases(self, remote, local, timeout):
+    """This runs the phases of a streamed remote_pull()."""
+
+    remote = _templates(remote)
+    local = _Template(local)
+    position = {}
+    hosts = []
+
+    def list_commands():
+      for values in self._host_values():
+        hosts.append(values)
+        roots = self._pull_roots(remote, values)
+        mgmt_command = self._pull_list_command(values['HOST'], roots)
+        position[id(mgmt_command)] = (int(values['INDEX']), roots)
+        yield mgmt_command
+
+    # list the files of every host
+    listings = {}
+    for mgmt_command in self._schedule(self._timed(list_commands(),
+                                                   timeout)):
+      idx, roots = position.pop(id(mgmt_command))
+      files = []
+      if mgmt_command.retcode == 0:
+        for line in mgmt_command.stdout.splitlines():
+          match = _PULL_LIST_RE.match(line)
+          if match is None:
+            continue
+          directory = roots[int(match.group(1))][0]
+          path = match.group(4)
+          if '..' in path.split('/'):
+            continue
+          files.append((directory, path, int(match.group(2)),
+                        match.group(3)))
+      listings[idx] = (mgmt_command, files)
+
+    # number the results in host and file order, the hosts without files
+    # are done already
+    transfers = collections.deque()
+    next_idx = 0
+    for idx, values in enumerate(hosts):
+      mgmt_command, files = listings.pop(idx)
+      if not files:
+        mgmt_command.index = next_idx
+        next_idx += 1
+        yield mgmt_command
+        continue
+      entries = []
+      for directory, path, size, digest in files:
+        entries.append((next_idx, values, directory, path, size, digest))
+        next_idx += 1
+      entries.sort(key=lambda entry: entry[4], reverse=True)
+      transfers.append(collections.deque(entries))
+
+    def transfer_commands():
+      # take the hosts in turns so that all of them make progress
+      while transfers:
+        entries = transfers.popleft()
+        idx, values, directory, path, size, digest = entries.popleft()
+        mgmt_command = self._pull_file_command(values, local, directory,
+                                               path, size, digest)
+        position[id(mgmt_command)] = idx
+        if entries:
+          transfers.append(entries)
+        yield mgmt_command
+
+    for mgmt_command in self._schedule(self._timed(transfer_commands(),
+                                                   timeout),
+                                       self._pull_streams):
+      mgmt_command.index = position.pop(id(mgmt_command))
+      yield mgmt_command
+
+  def _pull_roots(self, remote, values):
+    """This splits the remote paths of a host into directory and basename.
+
+    Files are listed from the directory of each remote path, so that they
+    land under the destination the way 'scp -r' would place them.
+
+    Args:
+      remote : The _Templates of the remote paths
+      values : The template values of the host
+    """
+
+    roots = []
+    for template in remote:
+      path = template.render(values)
+      if path != '/':
+        path = path.rstrip('/')
+      roots.append((posixpath.dirname(path) or '.',
+                    posixpath.basename(path) or '.'))
+    return roots
+
+  def _pull_list_command(self, host, roots):
+    """This creates the Command listing the files a host will send."""
+
+    # for each file: <root index> <size> <sha256>  <path>
+    describe = ('for f; do printf "%s %s %s\\n" "$0" $(wc -c < "$f") '
+                '"$(sha256sum "$f")"; done')
+    lists = []
+    for idx, (directory, base) in enumerate(roots):
+      lists.append('(cd {0} && find {1} -type f -exec sh -c {2} {3} {{}} +)'
+                   .format(_quote_path(directory), quote(base),
+                           quote(describe), idx))
+    command = [self._ssh_program]
+    command.extend(self._ssh_options())
+    rspec = self._rspec(host)
+    command.append(rspec)
+    command.append(' && '.join(lists))
+    desc = 'rpull [{0}]: listing {1}'.format(
+        rspec, ' '.join(posixpath.join(directory, base)
+                        for directory, base in roots))
+    mgmt_command = self._new_command(host, command, desc)
+    # the whole listing is parsed, so none of it may be left out
+    mgmt_command.capture_limit = None
+    return mgmt_command
+
+  def _pull_file_command(self, values, local, directory, path, size,
+                         digest):
+    """This creates the Command pulling one file, resuming a partial one."""
+
+    host = values['HOST']
+    dest = os.path.expanduser(local.render(values))
+    dest = os.path.join(dest, *posixpath.normpath(path).split('/'))
+    parent = os.path.dirname(dest)
+    if parent and not os.path.isdir(parent):
+      os.makedirs(parent)
+    offset = 0
+    if os.path.isfile(dest):
+      offset = os.path.getsize(dest)
+      if offset > size:
+        offset = 0
+
+    command = [self._ssh_program]
+    command.extend(self._ssh_options())
+    rspec = self._rspec(host)
+    command.append(rspec)
+    command.append('cd {0} && tail -c +{1} {2}'.format(
+        _quote_path(directory), offset + 1, quote(path)))
+    desc = 'rpull [{0}]: {0}:{1} => {2}'.format(
+        rspec, posixpath.join(directory, path), dest)
+    if 0 < offset < size:
+      desc += ' (resumed at {0} bytes)'.format(offset)
+    # the files of a host are pulled at once, so they can't share its
+    # output_dir files, and their stdout is the file anyway
+    mgmt_command = self._new_command(host, command, desc, output=False)
+    mgmt_command.stdout_file = dest
+    mgmt_command.stdout_offset = offset
+    mgmt_command.checksum = digest
+    return mgmt_command
+
+  def remote_script(self, scripts, timeout=None):
+    """Run local scripts on remote hosts via SSH.
+
+    Args:
+      scripts  : a list of local scripts to be run on the remote hosts.
+                 Template variables in script names are replaced.
+                 '?HOST' in the script is replaced, or all template
+                 variables with script_vars.
+      timeout  : Overrides the Controller's timeout for this call.
+
+    Returns:
+      A list of Command objects.
+    """
+
+    if self._script_cache is not None:
+      mgmt_commands = list(self._iter_cached_script(scripts, timeout))
+      mgmt_commands.sort(key=lambda mgmt_command: mgmt_command.index)
+      return mgmt_commands
+
+    mgmt_commands = list(self._timed(
+        self._remote_script_commands(scripts), timeout))
+    self._run_commands(mgmt_commands)
+    return mgmt_commands
+
+  def remote_script_iter(self, scripts, timeout=None):
+    """Like remote_script(), but yields each Command as it completes.
+
+    Args:
+      scripts  : a list of local scripts to be run on the remote hosts.
+                 Template variables in script names are replaced.
+                 '?HOST' in the script is replaced, or all template
+                 variables with script_vars.
+      timeout  : Overrides the Controller's timeout for this call.
+
+    Returns:
+      An iterator of Command objects in completion order (host order if
+      the Controller is ordered).
+    """
+
+    if self._script_cache is not None:
+      return self._iter_cached_script(scripts, timeout)
+    return self._iter_commands(self._timed(
+        self._remote_script_commands(scripts), timeout))
+
+  def remote_script_async(self, scripts, timeout=None):
+    """Like remote_script(), but returns a coroutine to be awaited.
+
+    This requires the asyncio engine.
+
+    Returns:
+      A coroutine returning a list of AsyncCommand objects.
+    """
+
+    self._require_asyncio()
+    if self._script_cache is not None:
+      raise EnvironmentError('remote_script_async does not support caching')
+    return self._run_commands_async(
+        list(self._timed(self._remote_script_commands(scripts), timeout)))
+
+  def _script_template(self, text):
+    """Returns the _Template of the text of a script bundle."""
+    if self._script_vars:
+      return _Template(text, strict=False)
+    return _Template(text, names=('HOST',))
+
+  def _remote_script_commands(self, scripts):
+    """This generates the Commands for remote_script()."""
+
+    scripts = _templates(scripts)
+    bundles = {}
+    for values in self._host_values():
+      host = values['HOST']
+      command = [self._ssh_program, '-T']
+      command.extend(self._ssh_options())
+      rspec = self._rspec(host)
+      command.append(rspec)
 
+      # read in and parse the text of the scripts once
+      script_names = tuple(script.render(values) for script in scripts)
+      if script_names not in bundles:
+        bundles[script_names] = self._script_template(
+            _script_bundle(script_names, _read_text))
 
-class Controller(object):
-  """This class offers parallel cluster management using SSH and SCP."""
+      desc = 'rscript [{0}]: running {1}'.format(rspec, ' '.join(script_names))
+      mgmt_command = self._new_command(host, command, desc,
+                                       bundles[script_names].render(values))
+      yield mgmt_command
 
-  def __init__(self, hosts, user=USER_DEFAULT, parallel=PARALLEL_DEFAULT,
-               quiet=QUIET_DEFAULT, color=COLOR_DEFAULT,
-               attempts=ATTEMPTS_DEFAULT):
-    """Constructor for Controller.
+  def _iter_cached_script(self, scripts, timeout):
+    """This runs scripts from the remote script cache, see remote_script().
 
-    Args:
-      hosts    : A list of hostnames.
-      user     : The remote user account.
-      parallel : Run commands in parallel.
-      quiet    : Suppress printing output to stdout.
-      color    : Color the output. Only enabled if sys.stdout.isatty() is true
-                 and not quiet and termcolor was successfully imported.
-      attempts : Maximum number of process tries.
-    """
+    Each distinct script bundle is read once and named by its SHA-256. Hosts
+    run the bundle from '<script_cache>/<hash>' with its template variables
+    substituted remotely by sed. Hosts that don't have the bundle yet report
+    a cache miss and are then sent the bundle, which is stored and run in a
+    single connection. The two connections of such a host share its timeout.
 
-    self._user = user
-    self._hosts = hosts
-    self._parallel = parallel
-    self._quiet = quiet
-    self._color = _should_color(color)
-    self._attempts = int(attempts)
-    self._ssh_connect_timeout = 2
-    self._ssh_connection_attempts = 3
+    Args:
+      scripts   : A list of local scripts
+      timeout   : The per-call timeout, or None
 
-  @property
-  def user(self):
-    return self._user
+    Returns:
+      An iterator of the final Command of each host as it completes
+    """
 
-  @user.setter
-  def user(self, val):
-    self._user = val
+    return self._report_iter(self._cached_script_phases(scripts, timeout),
+                             self._host_count())
 
-  @property
-  def parallel(self):
-    return self._parallel
+  def _cached_script_phases(self, scripts, timeout):
+    """This runs the phases of a cached remote_script()."""
 
-  @parallel.setter
-  def parallel(self, val):
-    self._parallel = val
+    contents = {}
 
-  @property
-  def quiet(self):
-    return self._quiet
+    def read_once(script_name):
+      if script_name not in contents:
+        contents[script_name] = _read_text(script_name)
+      return contents[script_name]
 
-  @quiet.setter
-  def quiet(self, val):
-    self._quiet = val
+    bundles = {}
+    position = {}
+    misses = []
 
-  @property
-  def color(self):
-    return self._color
+    templates = _templates(scripts)
 
-  @color.setter
-  def color(self, val, force=False):
-    if val and force:
-      if not CAN_COLOR:
-        raise EnvironmentError('package \'termcolor\' does not exist')
-      self._color = True
-    self._color = _should_color(val)
+    def run_commands():
+      for values in self._host_values():
+        script_names = tuple(template.render(values)
+                             for template in templates)
+        if script_names not in bundles:
+          bundle = self._script_template(_script_bundle(script_names,
+                                                        read_once))
+          digest = hashlib.sha256(bundle.text.encode('utf-8')).hexdigest()
+          bundles[script_names] = (bundle, digest)
+        bundle, digest = bundles[script_names]
+        mgmt_command = self._cached_script_command(values, script_names,
+                                                   bundle, digest)
+        position[id(mgmt_command)] = (values, script_names)
+        yield mgmt_command
 
-  @property
-  def attempts(self):
-    return self._attempts
+    # run from the cache, collecting the hosts that miss
+    for mgmt_command in self._schedule(self._timed(run_commands(), timeout)):
+      values, script_names = position.pop(id(mgmt_command))
+      if _script_cache_missed(mgmt_command):
+        misses.append((values, script_names, mgmt_command))
+        continue
+      mgmt_command.index = int(values['INDEX'])
+      yield mgmt_command
 
-  @attempts.setter
-  def attempts(self, val):
-    self._attempts = int(val)
+    # send the bundle to the hosts that missed, then run it
+    upload_commands = []
+    for values, script_names, missed in misses:
+      bundle, digest = bundles[script_names]
+      mgmt_command = self._cached_script_command(values, script_names,
+                                                 bundle, digest, True)
+      if missed.timeout is not None:
+        # the host gets one timeout for both phases
+        mgmt_command.timeout = max(0, missed.timeout -
+                                   (missed.finished_at - missed.started_at))
+      position[id(mgmt_command)] = int(values['INDEX'])
+      upload_commands.append(mgmt_command)
+    for mgmt_command in self._schedule(upload_commands):
+      mgmt_command.index = position.pop(id(mgmt_command))
+      yield mgmt_command
 
-  @property
-  def ssh_connect_timeout(self):
-    return self._ssh_connect_timeout
+  def _cached_script_command(self, values, script_names, bundle, digest,
+                             upload=False):
+    """This creates a Command running a bundle from the remote script cache.
 
-  @ssh_connect_timeout.setter
-  def ssh_connect_timeout(self, val):
-    self._ssh_connect_timeout = int(val)
+    Args:
+      values       : The template values of the host
+      script_names : The names of the scripts in the bundle
+      bundle       : The _Template of the bundle
+      digest       : The SHA-256 of the bundle
+      upload       : Whether the bundle is sent and stored in the cache
+                     first. Otherwise a missing bundle is reported with
+                     _SCRIPT_CACHE_MISS.
+    """
 
-  @property
-  def ssh_connection_attempts(self):
-    return self._ssh_connection_attempts
+    host = values['HOST']
+    path = _quote_path(posixpath.join(self._script_cache, digest))
+    substitute = []
+    for name in sorted(bundle.names):
+      if name not in values:
+        if not bundle.strict:
+          continue
+        raise ValueError('no value of ?{{{0}}} for {1}'.format(name, host))
+      value = (values[name].replace('\\', '\\\\').replace('/', '\\/')
+               .replace('&', '\\&'))
+      patterns = ['?{{{0}}}'.format(name)]
+      if name in ('HOST', 'USER', 'INDEX'):
+        patterns.append('?' + name)
+      for pattern in patterns:
+        substitute.append(quote('s/{0}/{1}/g'.format(pattern, value)))
+    if substitute:
+      expand = 'sed -e {0} {1}'.format(' -e '.join(substitute), path)
+    else:
+      expand = 'cat {0}'.format(path)
+    run = '{0} | PARAMGMT_HOST={1} "${{SHELL:-/bin/sh}}"'.format(
+        expand, quote(host))
+    if not upload:
+      remote = ('if [ -f {0} ]; then {1}; else echo {2} >&2; exit {3}; fi'
+                .format(path, run, quote(_SCRIPT_CACHE_MISS),
+                        _SCRIPT_CACHE_MISS_CODE))
+      action = 'running'
+    else:
+      remote = ('mkdir -p {0} && cat > {1}.$$ && mv -f {1}.$$ {1} && {2}'
+                .format(_quote_path(self._script_cache), path, run))
+      action = 'uploading and running'
 
-  @ssh_connection_attempts.setter
-  def ssh_connection_attempts(self, val):
-    self._ssh_connection_attempts = int(val)
+    command = [self._ssh_program, '-T']
+    command.extend(self._ssh_options())
+    rspec = self._rspec(host)
+    command.append(rspec)
+    command.append(remote)
+    desc = 'rscript [{0}]: {1} {2} (cached as {3})'.format(
+        rspec, action, ' '.join(script_names), digest[:12])
+    return self._new_command(host, command, desc,
+                             bundle.text if upload else None)
 
-  def _ssh_options(self):
-    return ['-o', 'PasswordAuthentication=no',
-            '-o', 'ConnectTimeout={0}'
-            .format(self._ssh_connect_timeout),
-            '-o', 'ConnectionAttempts={0}'
-            .format(self._ssh_connection_attempts)]
+  def remote_job(self, commands, job_id=None, timeout=None):
+    """Start remote commands detached on all hosts, without waiting for them.
 
-  def _run_commands(self, mgmt_commands):
-    """This runs the specified commands.
+    Each host runs the commands in the background under nohup (and setsid
+    where available), writing their stdout, stderr and return code to
+    '<job_dir>/<job_id>' on the host. No connection or thread is kept while
+    the job runs, see poll_job() and collect_job().
 
     Args:
-      mgmt_commands  : A list of Commands
+      commands : The remote commands.
+                 Template variables like '?HOST' are replaced.
+      job_id   : The id of the job, which must not exist on the hosts yet.
+                 If None, a new id is made up.
+      timeout  : Overrides the Controller's timeout for starting the job.
 
     Returns:
-      Nothing, but it completes mgmt_command objects
+      A Job whose launches are the Commands that started it.
     """
 
-    # run all commands
-    outstanding = []
-    failed = []
-    for mgmt_command in mgmt_commands:
-      mgmt_command.start()
-      if self._parallel:
-        outstanding.append(mgmt_command)
-      else:
-        mgmt_command.join()
-        if not self._quiet:
-          print(mgmt_command.status(self._color))
-        if mgmt_command.retcode is not 0:
-          failed.append(mgmt_command)
+    if job_id is None:
+      job_id = '{0}-{1:06x}'.format(time.strftime('%Y%m%d-%H%M%S'),
+                                    random.getrandbits(24))
+    mgmt_commands = list(self._timed(
+        self._remote_job_commands(commands, job_id), timeout))
+    self._run_commands(mgmt_commands)
+    return Job(job_id, mgmt_commands)
 
-    for mgmt_command in outstanding:
-      mgmt_command.join()
-      if not self._quiet:
-        print(mgmt_command.status(self._color))
-      if mgmt_command.retcode is not 0:
-        failed.append(mgmt_command)
-
-    # show stats
-    if not self._quiet:
-      total = len(mgmt_commands)
-      failures = len(failed)
-      successes = total - failures
-      print(('{0} succeeded, {1} failed, {2} total\n'
-             .format(successes, failures, total)))
-      if failures > 0:
-        print('Failed hosts:')
-        for mgmt_command in failed:
-          host = mgmt_command.host
-          if self._color:
-            host = colored(host, 'red')
-          print(host)
-
-  def local_command(self, commands):
-    """Run local command for all hosts specified.
+  def poll_job(self, job_id, timeout=None):
+    """Check the state of a job started by remote_job() on all hosts.
+
+    The Command of a host whose job is done has the job's return code. The
+    others fail with a message telling whether the job is running, lost or
+    missing. The first line of stderr tells the state, see job_state().
 
     Args:
-      commands : The local commands.
-                 '?HOST' is replaced with actual hostname.
+      job_id   : The id of the job
+      timeout  : Overrides the Controller's timeout for this call.
 
     Returns:
       A list of Command objects.
     """
 
-    # create a list of Commands for _run_commands()
-    mgmt_commands = []
-    for host in self._hosts:
-      command = []
-      for c in commands:
-        command.append(c.replace('?HOST', host))
-      command = ' '.join(command)
-      mgmt_command = Command(
-          host, ['/bin/sh'], self._attempts,
-          'lcmd [{0}]: {1}'.format(host, command),
-          command)
-      mgmt_commands.append(mgmt_command)
-
-    # run all commands
+    mgmt_commands = list(self._timed(
+        self._job_result_commands(job_id, False, False), timeout))
     self._run_commands(mgmt_commands)
     return mgmt_commands
 
-  def remote_command(self, commands):
-    """Run SSH command to all hosts specified.
+  def collect_job(self, job_id, remove=False, timeout=None):
+    """Fetch the results of a job started by remote_job() from all hosts.
+
+    Like poll_job(), but the Command of a host whose job is done also has
+    the job's stdout, and its stderr after the line telling the state.
 
     Args:
-      commands : The remote commands of the SSH command.
-                 '?HOST' is replaced with actual hostname.
+      job_id   : The id of the job
+      remove   : Also remove the job's directory from the hosts on which it
+                 is done.
+      timeout  : Overrides the Controller's timeout for this call.
 
     Returns:
       A list of Command objects.
     """
 
-    # create a list of Commands for _run_commands()
-    mgmt_commands = []
-    for host in self._hosts:
-      command = ['ssh']
-      command.extend(self._ssh_options())
-      if self._user:
-        rspec = '{0}@{1}'.format(self._user, host)
-      else:
-        rspec = '{0}'.format(host)
-      desc = 'rcmd [{0}]:'.format(rspec)
-      command.append(rspec)
-      for c in commands:
-        tmp = c.replace('?HOST', host)
-        command.append(tmp)
-        desc += ' {0}'.format(tmp)
-      mgmt_command = Command(host, command, self._attempts, desc)
-      mgmt_commands.append(mgmt_command)
-
-    # run all commands
+    mgmt_commands = list(self._timed(
+        self._job_result_commands(job_id, True, remove), timeout))
     self._run_commands(mgmt_commands)
     return mgmt_commands
 
-  def remote_push(self, local, remote):
-    """Push specified documents to all remote hosts via SCP.
+  def _job_path(self, job_id):
+    """Returns the quoted remote directory of a job."""
+    if not _JOB_ID_RE.match(job_id):
+      raise ValueError('bad job id: {0}'.format(job_id))
+    return _quote_path(posixpath.join(self._job_dir, job_id))
 
-    Args:
-      local     : A list of local file(s) and/or directory(ies)
-                  '?HOST' is replaced with actual hostname.
-      remote    : A string specification of the remote destination file(s).
-                  '?HOST' is replaced with actual hostname.
+  def _remote_job_commands(self, commands, job_id):
+    """This generates the Commands for remote_job()."""
 
-    Returns:
-      A list of Command objects.
-    """
+    path = self._job_path(job_id)
+    # the return code is moved into place once the output is complete
+    run = ('"${SHELL:-/bin/sh}" cmd > stdout 2> stderr; '
+           'echo $? > retcode.$$ && mv -f retcode.$$ retcode')
+    templates = _templates(commands)
+    for values in self._host_values():
+      host = values['HOST']
+      rspec = self._rspec(host)
+      command_text = ' '.join(template.render(values)
+                              for template in templates)
+      remote = ('mkdir -p {0} && mkdir {1} && cd {1} && '
+                'printf "%s\\n" {2} > cmd && '
+                '{{ $(command -v setsid) nohup sh -c {3} '
+                '< /dev/null > /dev/null 2>&1 & echo $! > pid; }}'
+                .format(_quote_path(self._job_dir), path,
+                        quote(command_text), quote(run)))
+      command = [self._ssh_program, '-T']
+      command.extend(self._ssh_options())
+      command.append(rspec)
+      command.append(remote)
+      desc = 'rjob [{0}]: started {1}: {2}'.format(rspec, job_id,
+                                                   command_text)
+      yield self._new_command(host, command, desc)
 
-    # create a list of Commands for _run_commands()
-    mgmt_commands = []
+  def _job_result_commands(self, job_id, output, remove):
+    """This generates the Commands for poll_job() and collect_job()."""
+
+    path = self._job_path(job_id)
+    pending = 'echo {{0}} >&2; exit {0}'.format(_JOB_PENDING_CODE)
+    remote = ('cd {0} 2>/dev/null || {{ {1}; }}; '
+              'if [ ! -f retcode ]; then '
+              'if kill -0 "$(cat pid 2>/dev/null)" 2>/dev/null; then {2}; fi; '
+              'if [ ! -f retcode ]; then {3}; fi; '
+              'fi; '
+              .format(path, pending.format(quote(_JOB_MISSING)),
+                      pending.format(quote(_JOB_RUNNING)),
+                      pending.format(quote(_JOB_LOST))))
+    remote += 'echo {0} >&2; '.format(quote(_JOB_DONE))
+    if output:
+      remote += 'cat stdout; cat stderr >&2; '
+    remote += 'ret=$(cat retcode); '
+    if remove:
+      remote += 'cd / && rm -rf {0}; '.format(path)
+    remote += 'exit $ret'
+    action = 'collect' if output else 'poll'
     for host in self._hosts:
-      command = ['scp', '-r']
+      rspec = self._rspec(host)
+      command = [self._ssh_program, '-T']
       command.extend(self._ssh_options())
-      if self._user:
-        rspec = '{0}@{1}'.format(self._user, host)
-      else:
-        rspec = '{0}'.format(host)
-      desc = 'rpush [{0}]: '.format(rspec)
-      for ll in local:
-        tmp = ll.replace('?HOST', host)
-        command.append(tmp)
-        desc += '{0} '.format(tmp)
-      desc += '=> '
-      tmp = '{0}:{1}'.format(rspec, remote.replace('?HOST', host))
-      command.append(tmp)
-      desc += tmp
-      mgmt_command = Command(host, command, self._attempts, desc)
-      mgmt_commands.append(mgmt_command)
-
-    # run all commands
-    self._run_commands(mgmt_commands)
-    return mgmt_commands
+      command.append(rspec)
+      command.append(remote)
+      desc = 'rjob [{0}]: {1} {2}'.format(rspec, action, job_id)
+      yield self._new_command(host, command, desc)
 
-  def remote_pull(self, remote, local):
-    """Push specified documents to all remote hosts via SCP.
 
-    Args:
-      remote    : A list of remote file(s) and/or directory(ies)
-                  '?HOST' is replaced with actual hostname.
-      local     : A string specification of the local destination file(s).
-                  '?HOST' is replaced with actual hostname.
+class _Archive(object):
+  """A tar archive of local files, built once and streamed to many hosts."""
 
-    Returns:
-      A list of Command objects.
+  def __init__(self, paths, codec, level):
+    """Constructor for _Archive.
+
+    Args:
+      paths : The local files and/or directories, each stored under its
+              basename
+      codec : One of TAR_CODECS
+      level : The compression level
     """
 
-    # create a list of Commands for _run_commands()
-    mgmt_commands = []
-    for host in self._hosts:
-      command = ['scp', '-r']
-      command.extend(self._ssh_options())
-      if self._user:
-        rspec = '{0}@{1}'.format(self._user, host)
-      else:
-        rspec = '{0}'.format(host)
-      desc = 'rpull [{0}]: '.format(rspec)
-      remote2 = ''
-      for idx, rr in enumerate(remote):
-        remote2 += rr.replace('?HOST', host)
-        if idx < (len(remote) - 1):
-          remote2 += ','
-      if len(remote) > 1:
-        remote2 = '{{{0}}}'.format(remote2)
-      tmp = '{0}:{1}'.format(rspec, remote2)
-      command.append(tmp)
-      desc += tmp
-      desc += ' => '
-      tmp = local.replace('?HOST', host)
-      command.append(tmp)
-      desc += tmp
-      mgmt_command = Command(host, command, self._attempts, desc)
-      mgmt_commands.append(mgmt_command)
-
-    # run all commands
-    self._run_commands(mgmt_commands)
-    return mgmt_commands
+    self.codec = codec
+    self.path = None
+    fd, self.path = tempfile.mkstemp(prefix='paramgmt-', suffix='.tar')
+    if codec == 'none':
+      mode, options = 'w', {}
+    elif codec == 'xz':
+      mode, options = 'w:xz', {'preset': level}
+    else:
+      mode, options = 'w:{0}'.format(codec), {'compresslevel': level}
+    with os.fdopen(fd, 'wb') as fileobj:
+      with tarfile.open(fileobj=fileobj, mode=mode, **options) as tar:
+        for path in paths:
+          tar.add(path, arcname=os.path.basename(path.rstrip('/')))
 
-  def remote_script(self, scripts):
-    """Run local scripts on remote hosts via SSH.
+  def open(self):
+    """Returns a new file object reading the archive from the start."""
+    return open(self.path, 'rb')
+
+  def __del__(self):
+    if self.path is not None:
+      try:
+        os.remove(self.path)
+      except OSError:
+        pass
+
+
+class _Capture(object):
+  """This captures one output stream of a process using bounded memory.
+
+  Up to 'limit' bytes are held in memory. Once a stream grows beyond that,
+  the whole stream is written to a spill file and only its first and last
+  limit/2 bytes stay in memory.
+  """
+
+  def __init__(self, host, name, limit=None, spill_dir=None, path=None,
+               offset=0):
+    """Constructor for _Capture.
 
     Args:
-      scripts  : a list of local scripts to be run on the remote hosts.
-                 '?HOST' in script names is replaced with actual hostname.
-                 '?HOST' in the script is replaced with actual hostname.
+      host      : The host, used to name the spill file
+      name      : The stream name, used to name the spill file
+      limit     : The maximum number of bytes held in memory, or None
+      spill_dir : The directory for spill files. If None, a temporary file is
+                  used and removed once this object is garbage collected.
+      path      : If given, the stream is written straight to this file and
+                  nearly nothing is held in memory.
+      offset    : The length of 'path' to keep. The stream is written after
+                  it instead of replacing the file.
+    """
 
-    Returns:
-      A list of Command objects.
+    self._host = host
+    self._name = name
+    self._limit = limit
+    self._spill_dir = spill_dir
+    self._head = bytearray()
+    self._tail = bytearray()
+    self._file = None
+    self.size = 0
+    self.first_at = None
+    self.path = path
+    self.to_file = path is not None
+    if self.to_file and offset:
+      self._file = open(path, 'ab')
+      self._file.truncate(offset)
+    elif self.to_file:
+      self._file = open(path, 'wb')
+
+  def _spill(self):
+    fd, self.path = tempfile.mkstemp(prefix='{0}.'.format(self._host),
+                                     suffix='.{0}'.format(self._name),
+                                     dir=self._spill_dir)
+    self._file = os.fdopen(fd, 'wb')
+    self._file.write(self._head)
+    keep = self._limit // 2
+    self._tail = self._head[len(self._head) - keep:]
+    del self._head[keep:]
+
+  def write(self, data):
+    """Adds bytes read from the stream."""
+    if self.first_at is None:
+      self.first_at = _now()
+    self.size += len(data)
+    if self.to_file:
+      self._file.write(data)
+      if len(self._head) < _PEEK_SIZE:
+        self._head += data[:_PEEK_SIZE - len(self._head)]
+    elif self._file is None:
+      self._head += data
+      if self._limit is not None and len(self._head) > self._limit:
+        self._spill()
+    else:
+      self._file.write(data)
+      self._tail += data
+      extra = len(self._tail) - self._limit // 2
+      if extra > 0:
+        del self._tail[:extra]
+
+  @property
+  def kept(self):
+    """Whether the file in 'path' outlives this object."""
+    return self.to_file or self._spill_dir is not None
+
+  def close(self):
+    """Finishes the capture, releasing the spill file descriptor."""
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+  def digest(self):
+    """Returns the SHA-256 of the whole stream."""
+    if self.path is not None:
+      return _file_digest(self.path)
+    return hashlib.sha256(bytes(self._head)).hexdigest()
+
+  def peek(self):
+    """Returns the beginning of the captured text without reading files."""
+    return bytes(self._head).decode('utf-8', 'replace')
+
+  def text(self):
+    """Returns the captured text without trailing newlines.
+
+    If the stream was spilled, the omitted middle is replaced by a note,
+    which names the spill file holding the complete stream if it is kept.
+    If the stream was written to a file, the file is read.
     """
 
-    # create a list of Commands for _run_commands()
-    mgmt_commands = []
-    for host in self._hosts:
-      command = ['ssh', '-T']
-      command.extend(self._ssh_options())
-      if self._user:
-        rspec = '{0}@{1}'.format(self._user, host)
+    if self.to_file:
+      with open(self.path, 'rb') as fd:
+        return fd.read().decode('utf-8', 'replace').rstrip('\n')
+    text = bytes(self._head).decode('utf-8', 'replace')
+    if self.path is not None:
+      omitted = self.size - len(self._head) - len(self._tail)
+      if self.kept:
+        text += '\n[... {0} bytes omitted, full output in {1} ...]\n'.format(
+            omitted, self.path)
       else:
-        rspec = '{0}'.format(host)
-      desc = 'rscript [{0}]: '.format(rspec)
-      command.append(rspec)
+        text += '\n[... {0} bytes omitted ...]\n'.format(omitted)
+      text += bytes(self._tail).decode('utf-8', 'replace')
+    return text.rstrip('\n')
 
-      # read in the text of the scripts
-      script_names = []
-      all_script = ''
-      for script in scripts:
-        script_name = script.replace('?HOST', host)
-        script_names.append(script_name)
-        with open(script_name, 'r') as fd:
-          all_script += fd.read()
-        if all_script[-1:] != '\n':
-          all_script += '\n'
-      if not all_script:
-        all_script = ':'
-
-      # format description and command
-      desc += 'running {0}'.format(' '.join(script_names))
-      mgmt_command = Command(host, command, self._attempts, desc,
-                             all_script.replace('?HOST', host))
-      mgmt_commands.append(mgmt_command)
-
-    # run all commands
-    self._run_commands(mgmt_commands)
-    return mgmt_commands
+  def __del__(self):
+    self.close()
+    if self.path is not None and not self.kept:
+      try:
+        os.remove(self.path)
+      except OSError:
+        pass
 
 
-class Command(threading.Thread):
-    """A container class for commands given to Controller."""
+def _popen_options(killable):
+  """Returns extra Popen arguments for a process that may need to be killed.
+
+  A process that may be killed, because of a timeout or a cancelled rollout,
+  is started in its own session so that it and all of its children can be
+  killed as a group. Other processes stay in the foreground process group so
+  that they receive a terminal's Ctrl-C.
+  """
+
+  if not killable:
+    return {}
+  if sys.version_info >= (3, 2):
+    return {'start_new_session': True}
+  return {'preexec_fn': os.setsid}
+
+
+def _kill_group(process):
+  """Kills a process started with _popen_options() and all its children."""
+  try:
+    os.killpg(process.pid, signal.SIGKILL)
+  except OSError:
+    pass
+
+
+def _pump(process, stdin, out, err, deadline=None):
+  """This moves data between a process and its captures until it exits.
+
+  Unlike Popen.communicate(), output is handed to the captures as it
+  arrives instead of being accumulated in memory.
+
+  Args:
+    process  : The Popen object, with piped stdout and stderr
+    stdin    : A file object read for the process's stdin, or None
+    out      : The _Capture receiving stdout
+    err      : The _Capture receiving stderr
+    deadline : The _now() time at which the process group is killed, or None
+
+  Returns:
+    A tuple of the return code of the process and whether it was killed
+    because the deadline passed
+  """
+
+  poller = select.poll()
+  readers = {process.stdout.fileno(): out, process.stderr.fileno(): err}
+  for fd in readers:
+    poller.register(fd, select.POLLIN)
+  writer = None
+  pending = b''
+  if process.stdin is not None:
+    writer = process.stdin.fileno()
+    poller.register(writer, select.POLLOUT)
+
+  killed_at = None
+  while readers or writer is not None:
+    wait_ms = None
+    if deadline is not None:
+      if killed_at is None:
+        remaining = deadline - _now()
+        if remaining <= 0:
+          _kill_group(process)
+          killed_at = _now()
+          remaining = _KILL_GRACE
+      else:
+        remaining = killed_at + _KILL_GRACE - _now()
+        if remaining <= 0:
+          # something outside the process group holds the pipes open
+          break
+      wait_ms = int(remaining * 1000) + 1
+    for fd, event in poller.poll(wait_ms):
+      if fd == writer:
+        done = not event & select.POLLOUT
+        if not done and not pending:
+          pending = stdin.read(_READ_CHUNK)
+          done = not pending
+        if not done:
+          try:
+            pending = pending[os.write(fd, pending[:_PIPE_CHUNK]):]
+          except OSError as ex:
+            if ex.errno != errno.EPIPE:
+              raise
+            done = True
+        if done:
+          poller.unregister(fd)
+          process.stdin.close()
+          writer = None
+      elif fd in readers:
+        data = os.read(fd, _READ_CHUNK)
+        if data:
+          readers[fd].write(data)
+        else:
+          poller.unregister(fd)
+          del readers[fd]
+
+  if writer is not None:
+    process.stdin.close()
+  process.stdout.close()
+  process.stderr.close()
+  if deadline is not None and killed_at is None:
+    # the process may keep running after closing its output
+    while process.poll() is None:
+      remaining = deadline - _now()
+      if remaining <= 0:
+        _kill_group(process)
+        killed_at = _now()
+        break
+      time.sleep(min(remaining, _EXIT_POLL))
+  return process.wait(), killed_at is not None
+
+
+class _CommandBase(object):
+    """The state and results shared by all command implementations."""
 
     def __init__(self, host, commands, max_attempts, description=None,
-                 stdin=None):
-      """Constructor for Command."""
-      threading.Thread.__init__(self)
+                 stdin=None, capture_limit=None, spill_dir=None,
+                 output_dir=None, timeout=None, retry_policy=None,
+                 launch_bucket=None):
       self.host = host
       self.commands = commands
       if description is not None:
         self.description = description
       else:
         self.description = self.commands
+      self.index = None
+      self.source = None
+      self.sync_stat = None
+      self.stdout_file = None
+      self.stdout_offset = 0
+      self.checksum = None
       self.attempts = 0
       self.max_attempts = max_attempts
+      self.capture_limit = capture_limit
+      self.spill_dir = spill_dir
+      self.output_dir = output_dir
+      self.timeout = timeout
+      self.deadline = None
+      if retry_policy is None:
+        retry_policy = _RetryPolicy()
+      self.retry_policy = retry_policy
+      self.launch_bucket = launch_bucket
       self.process = None
       self.retcode = None
-      if stdin:
+      self.timed_out = False
+      self.unreachable = False
+      self.remote = True
+      self.skipped = False
+      self.skip_reason = None
+      self.cancelled = False
+      self.cancellable = False
+      self.start_time = None
+      self.end_time = None
+      self.queued_at = _now()
+      self.started_at = None
+      self.finished_at = None
+      self.attempt_times = []
+      if not stdin:
+        self.stdin = None
+      elif isinstance(stdin, type(u'')):
         self.stdin = stdin.encode('utf-8')
       else:
-        self.stdin = None
-      self.stdout = None
-      self.stderr = None
+        self.stdin = stdin
+      self._out = None
+      self._err = None
 
-    def run(self):
-      """Runs the command, called by threading library."""
-      while self.attempts < self.max_attempts:
-        # attempt to run the process
-        self.attempts += 1
-        if self.stdin:
-          stdin_fd = subprocess.PIPE
-        else:
-          stdin_fd = None
-
-        self.process = subprocess.Popen(self.commands,
-                                        stdin=stdin_fd,
-                                        stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE)
-
-        out, err = self.process.communicate(input=self.stdin)
-        self.retcode = self.process.returncode
-        self.stdout = out.decode('utf-8')
-        self.stdout = self.stdout.rstrip('\n')
-        self.stderr = err.decode('utf-8')
-        self.stderr = self.stderr.rstrip('\n')
-        self.process = None
-        if self.retcode != 0:
-          ssh_error = False
-          for msg in SSH_ERROR_MSGS:
-            if self.stderr.startswith(msg):
-              ssh_error = True
-              break
-          if ssh_error:
-            continue
-          else:
-            break
+    @property
+    def stdout(self):
+      """The text written to stdout, None if the command has not run."""
+      if self._out is None:
+        return None
+      return self._out.text()
+
+    @property
+    def stderr(self):
+      """The text written to stderr, None if the command has not run."""
+      if self._err is None:
+        return None
+      return self._err.text()
+
+    @property
+    def stdout_path(self):
+      """The file holding all of stdout if it was written to a file."""
+      if self._out is None:
+        return None
+      return self._out.path
+
+    @property
+    def stderr_path(self):
+      """The file holding all of stderr if it was written to a file."""
+      if self._err is None:
+        return None
+      return self._err.path
+
+    def _rsync_stat(self, name):
+      """Returns a number from the --stats output of rsync, or None."""
+      if self.sync_stat is None or self._out is None:
+        return None
+      match = re.search(r'^{0}: ([\d,]+)'.format(re.escape(name)),
+                        self._out.text(), re.MULTILINE)
+      if match is None:
+        return None
+      return int(match.group(1).replace(',', ''))
+
+    @property
+    def bytes_transferred(self):
+      """The bytes a sync sent over the network, None if not a sync."""
+      return self._rsync_stat(self.sync_stat)
+
+    @property
+    def up_to_date(self):
+      """Whether a sync found nothing to transfer, None if not a sync."""
+      transferred = self._rsync_stat('Number of regular files transferred')
+      if transferred is None:
+        return None
+      return transferred == 0
+
+    def _killable(self):
+      """Whether the process is started to be killed as a group."""
+      return self.timeout is not None or self.cancellable
+
+    def cancel(self):
+      """Kills the running process and stops any further attempts."""
+      self.cancelled = True
+      process = self.process
+      if process is None:
+        return
+      if self._killable():
+        _kill_group(process)
+        return
+      try:
+        process.kill()
+      except OSError:
+        pass
+
+    def skip(self, reason):
+      """Marks the command to complete without running its process."""
+      self.skipped = True
+      self.skip_reason = reason
+
+    def _deadline(self):
+      """Returns the _now() time at which the command times out, or None."""
+      if self.timeout is None:
+        return None
+      return _now() + self.timeout
+
+    def _retry_delay(self):
+      """Returns the seconds to wait before retrying, or None to give up."""
+      delay = self.retry_policy.delay(self.attempts)
+      if self.deadline is not None and _now() + delay >= self.deadline:
+        return None
+      return delay
+
+    def _launch_delay(self):
+      """Returns the seconds to wait before launching a process.
+
+      The deadline is pushed back by as much, so that waiting for the
+      connection rate limit doesn't use up the timeout.
+      """
+      if self.launch_bucket is None:
+        return 0
+      delay = self.launch_bucket.reserve()
+      if self.deadline is not None:
+        self.deadline += delay
+      return delay
+
+    def _open_stdin(self):
+      """Returns a file object for the stdin of an attempt, or None."""
+      if self.stdin is None:
+        return None
+      if isinstance(self.stdin, bytes):
+        return io.BytesIO(self.stdin)
+      return self.stdin.open()
+
+    def _start_attempt(self):
+      """Prepares the output captures of a new attempt.
+
+      Returns:
+        A tuple of the stdout and stderr _Captures
+      """
+
+      self.attempts += 1
+      if self.start_time is None:
+        self.start_time = time.time()
+      self._spawned_at = _now()
+      paths = {}
+      for name in ('out', 'err'):
+        if self.output_dir is not None:
+          paths[name] = os.path.join(self.output_dir,
+                                     '{0}.{1}'.format(self.host, name))
         else:
-          break
+          paths[name] = None
+      offset = 0
+      if self.stdout_file is not None:
+        paths['out'] = self.stdout_file
+        offset = self.stdout_offset
+      self._out = _Capture(self.host, 'out', self.capture_limit,
+                           self.spill_dir, paths['out'], offset)
+      self._err = _Capture(self.host, 'err', self.capture_limit,
+                           self.spill_dir, paths['err'])
+      return self._out, self._err
+
+    def _finish_attempt(self, retcode, timed_out=False):
+      """Records the result of an attempt.
+
+      Args:
+        retcode   : The return code of the process
+        timed_out : Whether the process was killed for exceeding the timeout
+
+      Returns:
+        True if the attempt failed due to SSH and should be retried
+      """
+
+      self._out.close()
+      if self.checksum is not None and retcode == 0 and not timed_out:
+        digest = _file_digest(self.stdout_file)
+        if digest != self.checksum:
+          # start over next time instead of resuming a corrupt file
+          os.remove(self.stdout_file)
+          self._err.write('{0}: expected {1}, got {2}, removed {3}\n'.format(
+              _CHECKSUM_MISMATCH, self.checksum, digest,
+              self.stdout_file).encode('utf-8'))
+          retcode = _CHECKSUM_MISMATCH_CODE
+      self._err.close()
+      self.retcode = retcode
+      self.timed_out = timed_out
+      self.process = None
+      self.end_time = time.time()
+      self.finished_at = _now()
+      first_bytes = [capture.first_at for capture in (self._out, self._err)
+                     if capture.first_at is not None]
+      self.attempt_times.append(AttemptTime(
+          self._spawned_at, min(first_bytes) if first_bytes else None,
+          self.finished_at))
+      self.unreachable = False
+      if self.retcode != 0 and not self.timed_out and not self.cancelled:
+        stderr = self._err.peek()
+        for msg in _UNREACHABLE_MSGS:
+          if stderr.startswith(msg):
+            self.unreachable = True
+        for msg in SSH_ERROR_MSGS:
+          if stderr.startswith(msg):
+            self.unreachable = True
+            return True
+      return False
+
+    @property
+    def duration(self):
+      """The seconds from the first launch to the end of the last attempt."""
+      if self.start_time is None or self.end_time is None:
+        return None
+      return self.end_time - self.start_time
+
+    @property
+    def queue_time(self):
+      """The seconds the command waited to be started, None if not run."""
+      if self.started_at is None:
+        return None
+      return self.started_at - self.queued_at
+
+    @property
+    def latency(self):
+      """The seconds from being started to completion, None if not run."""
+      if self.started_at is None or self.finished_at is None:
+        return None
+      return self.finished_at - self.started_at
+
+    @property
+    def retry_time(self):
+      """The seconds spent after the first attempt, backoff included."""
+      if len(self.attempt_times) < 2:
+        return 0
+      return self.finished_at - self.attempt_times[0].end
+
+    @property
+    def first_byte_time(self):
+      """The seconds from spawning the last attempt to its first output."""
+      if not self.attempt_times or self.attempt_times[-1].first_byte is None:
+        return None
+      return self.attempt_times[-1].first_byte - self.attempt_times[-1].spawn
+
+    def record(self):
+      """Returns the result of the command as a dict of JSON-ready values.
+
+      The output of a stream written to a file is not read, only its path
+      given as 'stdout_path' or 'stderr_path'. These are also given for
+      streams spilled to spill_dir, but not for temporary spill files, which
+      are removed with the Command.
+      """
+
+      result = {'host': self.host,
+                'index': self.index,
+                'description': self.description,
+                'retcode': self.retcode,
+                'timed_out': self.timed_out,
+                'skipped': self.skipped,
+                'skip_reason': self.skip_reason,
+                'unreachable': self.unreachable,
+                'cancelled': self.cancelled,
+                'attempts': self.attempts,
+                'start_time': self.start_time,
+                'end_time': self.end_time,
+                'duration': self.duration,
+                'queue_time': self.queue_time,
+                'latency': self.latency,
+                'retry_time': self.retry_time,
+                'first_byte_time': self.first_byte_time}
+      for name, capture in (('stdout', self._out), ('stderr', self._err)):
+        if capture is None:
+          result[name] = result[name + '_path'] = None
+          continue
+        result[name] = None if capture.to_file else capture.text()
+        result[name + '_path'] = capture.path if capture.kept else None
+      if self.source is not None:
+        result['source'] = self.source
+      transferred = self.bytes_transferred
+      if transferred is not None:
+        result['bytes_transferred'] = transferred
+        result['up_to_date'] = self.up_to_date
+      return result
+
+    def _shown(self, capture):
+      """Returns the text status() shows for an output stream."""
+      if capture is None:
+        return None
+      if capture.to_file:
+        if capture.size:
+          return '({0} bytes in {1})'.format(capture.size, capture.path)
+        return None
+      return capture.text()
 
     def status(self, color=True):
       """This displays the result of the command.
@@ -503,40 +4109,156 @@ class Command(threading.Thread):
       """
 
       color = _should_color(color)
-      text = []
-
       if color:
-        text.append('{0}'.format(colored(self.description, 'blue')))
+        text = ['{0}'.format(colored(self.description, 'blue'))]
       else:
-        text.append('{0}'.format(self.description))
+        text = ['{0}'.format(self.description)]
+      text.extend(self._result_lines(color))
+      return '\n'.join(text)
+
+    def _result_lines(self, color, attempts=True):
+      """Returns the lines of status() that follow the description.
+
+      Args:
+        color    : whether or not to color the output
+        attempts : whether to show the number of attempts
+      """
 
-      if self.stdout:
+      text = []
+      stdout = self._shown(self._out)
+      if stdout:
         if color:
-          text.append('stdout:\n{0}'.format(colored(self.stdout, 'green')))
+          text.append('stdout:\n{0}'.format(colored(stdout, 'green')))
         else:
-          text.append('stdout:\n{0}'.format(self.stdout))
+          text.append('stdout:\n{0}'.format(stdout))
 
-      if self.stderr:
+      stderr = self._shown(self._err)
+      if stderr:
         if color:
           if self.retcode is not 0:
-            text.append('stderr:\n{0}'.format(colored(self.stderr, 'red')))
+            text.append('stderr:\n{0}'.format(colored(stderr, 'red')))
           else:
-            text.append('stderr:\n{0}'.format(colored(self.stderr, 'yellow')))
+            text.append('stderr:\n{0}'.format(colored(stderr, 'yellow')))
+        else:
+          text.append('stderr:\n{0}'.format(stderr))
+
+      transferred = self.bytes_transferred
+      if transferred is not None:
+        if self.up_to_date:
+          text.append('transferred: {0} bytes (up to date)'
+                      .format(transferred))
+        else:
+          text.append('transferred: {0} bytes'.format(transferred))
+
+      if self.skipped:
+        if color:
+          text.append('skipped:     {0}'.format(colored(self.skip_reason,
+                                                        'red')))
+        else:
+          text.append('skipped:     {0}'.format(self.skip_reason))
+      elif self.cancelled:
+        if color:
+          text.append('cancelled:   {0}'.format(colored('rollout aborted',
+                                                        'red')))
         else:
-          text.append('stderr:\n{0}'.format(self.stderr))
+          text.append('cancelled:   rollout aborted')
+
+      if self.timed_out:
+        timeout = 'after {0} seconds'.format(self.timeout)
+        if color:
+          text.append('timed out:   {0}'.format(colored(timeout, 'red')))
+        else:
+          text.append('timed out:   {0}'.format(timeout))
 
       if self.retcode is not 0:
         if color:
           text.append('return code: {0}'.format(colored(self.retcode, 'red')))
-          text.append('attempts:    {0}'.format(colored(self.attempts, 'red')))
         else:
           text.append('return code: {0}'.format(self.retcode))
+        if attempts and color:
+          text.append('attempts:    {0}'.format(colored(self.attempts, 'red')))
+        elif attempts:
           text.append('attempts:    {0}'.format(self.attempts))
-      elif self.attempts is not 1:
+      elif attempts and self.attempts is not 1:
         if color:
           text.append('attempts:    {0}'.format(colored(self.attempts,
                                                         'yellow')))
         else:
           text.append('attempts:    {0}'.format(self.attempts))
 
-      return '\n'.join(text)
+      return text
+
+
+class Command(_CommandBase, threading.Thread):
+    """A container class for commands given to Controller."""
+
+    def __init__(self, host, commands, max_attempts, description=None,
+                 stdin=None, capture_limit=None, spill_dir=None,
+                 output_dir=None, timeout=None, retry_policy=None,
+                 launch_bucket=None):
+      """Constructor for Command."""
+      threading.Thread.__init__(self)
+      _CommandBase.__init__(self, host, commands, max_attempts, description,
+                            stdin, capture_limit, spill_dir, output_dir,
+                            timeout, retry_policy, launch_bucket)
+      self.done_queue = None
+
+    def run(self):
+      """Runs the command, called by threading library."""
+      self.started_at = _now()
+      try:
+        self._run_attempts()
+      finally:
+        if self.done_queue is not None:
+          self.done_queue.put(self)
+
+    def _run_attempts(self):
+      """Runs the process until success, a non-SSH failure, or max_attempts."""
+      self.deadline = self._deadline()
+      while (self.attempts < self.max_attempts and not self.cancelled and
+             not self.skipped):
+        retry = self.attempts > 0
+        if retry:
+          delay = self._retry_delay()
+          if delay is None:
+            break
+          time.sleep(delay)
+          self.retry_policy.acquire()
+          if self.cancelled:
+            self.retry_policy.release()
+            break
+        try:
+          again = self._run_attempt()
+        finally:
+          if retry:
+            self.retry_policy.release()
+        if not again:
+          break
+
+    def _run_attempt(self):
+      """Runs the process once, returning whether to retry."""
+      delay = self._launch_delay()
+      if delay > 0:
+        time.sleep(delay)
+      if self.cancelled:
+        return False
+      out, err = self._start_attempt()
+      if self.stdin:
+        stdin_fd = subprocess.PIPE
+      else:
+        stdin_fd = None
+
+      self.process = subprocess.Popen(self.commands,
+                                      stdin=stdin_fd,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE,
+                                      **_popen_options(self._killable()))
+
+      stdin = self._open_stdin()
+      try:
+        retcode, timed_out = _pump(self.process, stdin, out, err,
+                                   self.deadline)
+      finally:
+        if stdin is not None:
+          stdin.close()
+      return self._finish_attempt(retcode, timed_out)
@@ -30,6 +30,7 @@ setup(
     url='http://github.com/google/paramgmt',
     packages=['paramgmt'],
     scripts=['bin/rhosts', 'bin/lcmd', 'bin/rcmd',
-             'bin/rpull', 'bin/rpush', 'bin/rscript'],
+             'bin/rpull', 'bin/rpush', 'bin/rscript',
+             'bin/rjob'],
     install_requires=['termcolor >= 1.1.0'],
     )
@@ -66,14 +66,14 @@ for test_id in $(seq 1 $TESTS); do
   echo "***********************************************"
   echo ""
 
-  if ! which rhosts lcmd rcmd rpush rpull rscript > /dev/null; then
+  if ! which rhosts lcmd rcmd rpush rpull rscript rjob > /dev/null; then
     echo "paramgmt executables aren't present, please install"
     exit -1
   fi
 
   load_hosts ${HOSTFILE}
 
-  tmp=`python -c "import tempfile; print tempfile.mkdtemp()"`
+  tmp=`python -c "import tempfile; print(tempfile.mkdtemp())"`
 
   lcmd -f ${HOSTFILE} -- mkdir -p $tmp/?HOST
   assert "$? -eq 0" $LINENO
@@ -205,6 +205,220 @@ for test_id in $(seq 1 $TESTS); do
     "echo 'This is error text' 1>&2 && echo 'This is normal text'"
   assert "$? -eq 0" $LINENO
 
+  # host expressions expand numeric ranges
+  lcmd -m "node[01-03]" -- mkdir -p $tmp/?HOST
+  assert "$? -eq 0" $LINENO
+  for host in node01 node02 node03; do
+    assert "-d $tmp/$host" $LINENO
+  done
+
+  # output: grouped, jsonl in host order, and one file per host
+  rcmd -f ${HOSTFILE} -g -- echo grouped > $tmp/group.txt
+  assert "$? -eq 0" $LINENO
+  grep -q "(${#hosts[@]})$" $tmp/group.txt
+  assert "$? -eq 0" $LINENO
+
+  rcmd -f ${HOSTFILE} -o -n 2 -R 20 -F jsonl -- echo ?HOST > $tmp/jsonl.txt
+  assert "$? -eq 0" $LINENO
+  order=`grep -o '"host": "[^"]*"' $tmp/jsonl.txt | cut -d '"' -f 4`
+  test "`echo $order`" = "${hosts[*]}"
+  assert "$? -eq 0" $LINENO
+  for host in ${hosts[*]}; do
+    grep -q "\"stdout\": \"$host\"" $tmp/jsonl.txt
+    assert "$? -eq 0" $LINENO
+  done
+
+  rcmd -f ${HOSTFILE} -p -O $tmp/out -- "echo out ?HOST; echo err ?HOST 1>&2"
+  assert "$? -eq 0" $LINENO
+  lcmd -f ${HOSTFILE} -O $tmp/lout -- echo local ?HOST
+  assert "$? -eq 0" $LINENO
+  for host in ${hosts[*]}; do
+    grep -qx "out $host" $tmp/out/$host.out
+    assert "$? -eq 0" $LINENO
+    grep -qx "err $host" $tmp/out/$host.err
+    assert "$? -eq 0" $LINENO
+    grep -qx "local $host" $tmp/lout/$host.out
+    assert "$? -eq 0" $LINENO
+  done
+
+  # timeouts and retries
+  rcmd -f ${HOSTFILE} -t 1 -F jsonl -- sleep 10 > $tmp/timeout.txt
+  assert "$? -ne 0" $LINENO
+  count=`grep -c '"timed_out": true' $tmp/timeout.txt`
+  assert "$count -eq ${#hosts[@]}" $LINENO
+
+  # the first attempt on each host fails like a dropped connection
+  rcmd -f ${HOSTFILE} -a 2 -F jsonl -- \
+    "test -f $tmp/?HOST/retried || { touch $tmp/?HOST/retried;" \
+    "echo 'Connection timed out during banner exchange' 1>&2; exit 255; }" \
+    > $tmp/retry.txt
+  assert "$? -eq 0" $LINENO
+  count=`grep -c '"attempts": 2' $tmp/retry.txt`
+  assert "$count -eq ${#hosts[@]}" $LINENO
+
+  # rollouts: a failed canary stops the other hosts from starting
+  rcmd -f ${HOSTFILE} --canary 1 --max_failures 0 -F jsonl -- \
+    "touch $tmp/?HOST/canary; false" > $tmp/canary.txt
+  assert "$? -ne 0" $LINENO
+  count=`grep -c '"skip_reason": "rollout aborted"' $tmp/canary.txt`
+  assert "$count -eq $((${#hosts[@]} - 1))" $LINENO
+  rcmd -f ${HOSTFILE} -F jsonl -- test -f $tmp/?HOST/canary > $tmp/canary.txt
+  count=`grep -c '"retcode": 0' $tmp/canary.txt`
+  assert "$count -eq 1" $LINENO
+
+  if [[ ${#hosts[@]} -gt 2 ]]; then
+    rcmd -f ${HOSTFILE} --wave 1 --max_failure_ratio 0.5 --cancel \
+      -F jsonl -- false > $tmp/ratio.txt
+    assert "$? -ne 0" $LINENO
+    count=`grep -c '"retcode": 1' $tmp/ratio.txt`
+    assert "$count -eq 2" $LINENO
+  fi
+
+  # health cache: an unresolvable host is remembered, then skipped
+  bad=paramgmt-test.invalid
+  rcmd -m ${hosts[*]} $bad --health_cache $tmp/health.json -- true
+  assert "$? -ne 0" $LINENO
+  assert "-s $tmp/health.json" $LINENO
+  rcmd -m ${hosts[*]} $bad --health_cache $tmp/health.json \
+    --health_ttl 600 --dead_hosts skip -F jsonl -- true > $tmp/health.txt
+  grep "\"host\": \"$bad\"" $tmp/health.txt | grep -q '"skipped": true'
+  assert "$? -eq 0" $LINENO
+  count=`grep -c '"retcode": 0' $tmp/health.txt`
+  assert "$count -eq ${#hosts[@]}" $LINENO
+
+  rhosts -f ${HOSTFILE} -p --port 22 -t 5 -n 8 > $tmp/live.txt
+  assert "$? -eq 0" $LINENO
+  count=`cat $tmp/live.txt | wc -l`
+  assert "$count -eq ${#hosts[@]}" $LINENO
+  rhosts -m $bad -p -t 5
+  assert "$? -ne 0" $LINENO
+
+  # pushes: rsync, a tar stream and a relay
+  rcmd -f ${HOSTFILE} -- mkdir -p $tmp/?HOST/sync $tmp/relay
+  assert "$? -eq 0" $LINENO
+  rpush -f ${HOSTFILE} -y -d $tmp/?HOST/sync/ -- \
+    $tmp/test1.txt $tmp/test2.txt
+  assert "$? -eq 0" $LINENO
+  rcmd -f ${HOSTFILE} -- "grep -qx 'test 1' $tmp/?HOST/sync/test1.txt &&" \
+    "grep -qx 'test 2' $tmp/?HOST/sync/test2.txt"
+  assert "$? -eq 0" $LINENO
+
+  mkdir -p $tmp/bundle && cp $tmp/test*.txt $tmp/bundle/
+  assert "$? -eq 0" $LINENO
+  rpush -f ${HOSTFILE} -z gz --tar_level 1 -d $tmp/?HOST/tar -- $tmp/bundle
+  assert "$? -eq 0" $LINENO
+  rcmd -f ${HOSTFILE} -- grep -qx "'test 3'" $tmp/?HOST/tar/bundle/test3.txt
+  assert "$? -eq 0" $LINENO
+
+  rpush -f ${HOSTFILE} -r 1 --relay_agent -d $tmp/relay/ -- $tmp/test3.txt
+  assert "$? -eq 0" $LINENO
+  rcmd -f ${HOSTFILE} -- grep -qx "'test 3'" $tmp/relay/test3.txt
+  assert "$? -eq 0" $LINENO
+
+  # pulls: rsync, and streams resuming and verifying partial files
+  lcmd -f ${HOSTFILE} -- mkdir -p $tmp/?HOST/rsync
+  assert "$? -eq 0" $LINENO
+  rpull -f ${HOSTFILE} -y -d $tmp/?HOST/rsync/ -- $tmp/?HOST/sync/test2.txt
+  assert "$? -eq 0" $LINENO
+  for host in ${hosts[*]}; do
+    grep -qx "test 2" $tmp/$host/rsync/test2.txt
+    assert "$? -eq 0" $LINENO
+  done
+
+  rpull -f ${HOSTFILE} -P 2 -d $tmp/?HOST/streams/ -- \
+    $tmp/?HOST/sync/test1.txt $tmp/?HOST/sync/test2.txt
+  assert "$? -eq 0" $LINENO
+  lcmd -f ${HOSTFILE} -- printf test \> $tmp/?HOST/streams/test1.txt
+  assert "$? -eq 0" $LINENO
+  rpull -f ${HOSTFILE} -P 2 -d $tmp/?HOST/streams/ -- \
+    $tmp/?HOST/sync/test1.txt $tmp/?HOST/sync/test2.txt > $tmp/resume.txt
+  assert "$? -eq 0" $LINENO
+  count=`grep -c "test1.txt (resumed at 4 bytes)" $tmp/resume.txt`
+  assert "$count -eq ${#hosts[@]}" $LINENO
+  for host in ${hosts[*]}; do
+    grep -qx "test 1" $tmp/$host/streams/test1.txt
+    assert "$? -eq 0" $LINENO
+    grep -qx "test 2" $tmp/$host/streams/test2.txt
+    assert "$? -eq 0" $LINENO
+  done
+
+  # a partial file with other contents fails its checksum and is removed
+  lcmd -f ${HOSTFILE} -- printf XXXX \> $tmp/?HOST/streams/test1.txt
+  assert "$? -eq 0" $LINENO
+  rpull -f ${HOSTFILE} -P 2 -d $tmp/?HOST/streams/ -- \
+    $tmp/?HOST/sync/test1.txt
+  assert "$? -ne 0" $LINENO
+  for host in ${hosts[*]}; do
+    assert "! -e $tmp/$host/streams/test1.txt" $LINENO
+  done
+  rpull -f ${HOSTFILE} -P 2 -d $tmp/?HOST/streams/ -- \
+    $tmp/?HOST/sync/test1.txt
+  assert "$? -eq 0" $LINENO
+  for host in ${hosts[*]}; do
+    grep -qx "test 1" $tmp/$host/streams/test1.txt
+    assert "$? -eq 0" $LINENO
+  done
+
+  # host files: includes, groups, exclusions and ?{var} templates
+  if [[ ${#hosts[@]} -gt 1 ]]; then
+    hostfile=`readlink -f ${HOSTFILE}`
+    echo "include $hostfile" > $tmp/inventory.txt
+    echo "@first = ${hosts[0]}" >> $tmp/inventory.txt
+    echo "-@first" >> $tmp/inventory.txt
+    echo "${hosts[*]} role=test$test_id" >> $tmp/inventory.txt
+    rhosts -f $tmp/inventory.txt > $tmp/inventory_hosts.txt
+    assert "$? -eq 0" $LINENO
+    test "`echo $(cat $tmp/inventory_hosts.txt)`" = "${hosts[*]:1}"
+    assert "$? -eq 0" $LINENO
+
+    rcmd -f $tmp/inventory.txt -- test ?{role} = test$test_id
+    assert "$? -eq 0" $LINENO
+
+    echo "#!/bin/sh" > $tmp/role.sh
+    echo "echo ?{role} > $tmp/?HOST/role.txt" >> $tmp/role.sh
+    rscript -f $tmp/inventory.txt -C $tmp/cache --script_vars -- \
+      $tmp/role.sh
+    assert "$? -eq 0" $LINENO
+    rcmd -f $tmp/inventory.txt -- grep -qx test$test_id $tmp/?HOST/role.txt
+    assert "$? -eq 0" $LINENO
+    rcmd -m ${hosts[0]} -- test ! -e $tmp/${hosts[0]}/role.txt
+    assert "$? -eq 0" $LINENO
+    rscript -f $tmp/inventory.txt -C $tmp/cache --script_vars -- \
+      $tmp/role.sh > $tmp/cached.txt
+    assert "$? -eq 0" $LINENO
+    count=`grep -c "(cached as [0-9a-f]*)$" $tmp/cached.txt`
+    assert "$count -eq $((${#hosts[@]} - 1))" $LINENO
+  fi
+
+  # detached jobs: submit, poll until done, collect and remove
+  job=test$test_id
+  rjob -f ${HOSTFILE} -d $tmp/jobs -j $job -- "sleep 3; echo job ?HOST" \
+    > $tmp/job.txt
+  assert "$? -eq 0" $LINENO
+  grep -qx "job: $job" $tmp/job.txt
+  assert "$? -eq 0" $LINENO
+  rjob -f ${HOSTFILE} -d $tmp/jobs -j $job -P > $tmp/poll.txt
+  assert "$? -ne 0" $LINENO
+  grep -q "^running (${#hosts[@]}): " $tmp/poll.txt
+  assert "$? -eq 0" $LINENO
+  for i in $(seq 1 30); do
+    sleep 1
+    rjob -f ${HOSTFILE} -d $tmp/jobs -j $job -P -F jsonl > $tmp/poll.txt \
+      && break
+  done
+  count=`grep -c '"state": "done"' $tmp/poll.txt`
+  assert "$count -eq ${#hosts[@]}" $LINENO
+  rjob -f ${HOSTFILE} -d $tmp/jobs -j $job -C -r -F jsonl > $tmp/collect.txt
+  assert "$? -eq 0" $LINENO
+  for host in ${hosts[*]}; do
+    grep -q "\"stdout\": \"job $host\"" $tmp/collect.txt
+    assert "$? -eq 0" $LINENO
+  done
+  rjob -f ${HOSTFILE} -d $tmp/jobs -j $job -P -F jsonl > $tmp/poll.txt
+  assert "$? -ne 0" $LINENO
+  count=`grep -c '"state": "missing"' $tmp/poll.txt`
+  assert "$count -eq ${#hosts[@]}" $LINENO
+
   rcmd -f ${HOSTFILE} -- rm -rf $tmp
   assert "$? -eq 0" $LINENO
 